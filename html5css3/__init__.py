@@ -15,21 +15,18 @@ this code is based on html4css1
 from __future__ import absolute_import
 __docformat__ = 'reStructuredText'
 
-import codecs
 import os
 import re
 import json
+import tempfile
 
 import os.path
 
-try:
-    import Image                        # check for the Python Imaging Library
-except ImportError:
-    Image = None
-
 from docutils import frontend, nodes, utils, writers, languages
+from docutils.io import FileOutput
 
-from . import html
+from . import assets, compress, html, parallel
+from .timing import NULL_TIMINGS, Timings, timed_translator
 from .html import *
 # import default post processors so they register
 from . import postprocessors
@@ -47,6 +44,37 @@ def parse_param_value(value):
     except ValueError:
         return value
 
+def get_postprocessor_params(settings, opt_name):
+    """
+    Return the params for the postprocessor ``opt_name`` parsed from its
+    "-opts" setting.
+    """
+    params_str = getattr(settings, opt_name + "_opts") or ""
+    pairs = []
+
+    for keyval in params_str.split(","):
+        if "=" not in keyval:
+            continue
+        key, val = keyval.split("=", 1)
+        parsed_val = parse_param_value(val)
+        pairs.append((key, parsed_val))
+
+    params = {}
+    # a key that appears more than once is converted into a list
+    # of the found values
+    for key, val in pairs:
+        if key in params:
+            current_val = params[key]
+
+            if isinstance(current_val, list):
+                current_val.append(val)
+            else:
+                params[key] = [current_val, val]
+        else:
+            params[key] = val
+
+    return params
+
 DIR_NAME = os.path.dirname(__file__)
 class Writer(writers.Writer):
 
@@ -162,6 +190,10 @@ class Writer(writers.Writer):
          ('Path to custom math CSS file.',
           ['--math-css'],
           {'default': None}),
+         ('Directory where converted MathML and HTML formulas are cached '
+          'between runs.',
+          ['--math-cache-dir'],
+          {'default': None, 'metavar': '<dir>'}),
          ('Omit the XML declaration.  Use with caution.',
           ['--no-xml-declaration'],
           {'dest': 'xml_declaration', 'default': 1, 'action': 'store_false',
@@ -176,6 +208,16 @@ class Writer(writers.Writer):
           ['--embed-content'],
           {'default': 1, 'action': 'store_true',
            'validator': frontend.validate_boolean}),
+         ('Instead of embedding the content (css, js, etc) copy each file '
+          'once to <dir> under a name with the hash of its content and link '
+          'to it, so several pages share the files and browsers can cache '
+          'them forever.',
+          ['--asset-dir'],
+          {'default': None, 'metavar': '<dir>'}),
+         ('URL of the --asset-dir directory used in the links. Default: the '
+          'path of the directory relative to the output file.',
+          ['--asset-url'],
+          {'default': None, 'metavar': '<url>'}),
           ('Emit Body only',
                   ['--emit-body'],
                   {
@@ -185,20 +227,76 @@ class Writer(writers.Writer):
                   }),
          ('Add a favicon to the generated page',
           ['--favicon'],
-          {'default': None}),])
+          {'default': None}),
+         ('Write the output file in chunks while it is serialized instead '
+          'of building the whole page in memory first. Only used when the '
+          'destination is a file. Without postprocessors the top level '
+          'sections are also moved to a temporary file as they are '
+          'translated, freeing their tags and doctree.',
+          ['--stream-output'],
+          {'default': 0, 'action': 'store_true',
+           'validator': frontend.validate_boolean}),
+         ('Also write the output compressed next to it, <formats> is a '
+          'comma separated list of "gz" and "br" (brotli, needs the brotli '
+          'package). The output is compressed while it is written, only '
+          'used when the destination is a file.',
+          ['--precompress'],
+          {'metavar': '<formats>', 'default': None,
+           'validator': frontend.validate_comma_separated_list}),
+         ('Compression level of --precompress, up to 9 for gzip and 11 for '
+          'brotli, higher levels are lowered to those. Default: the highest.',
+          ['--compression-level'],
+          {'metavar': '<N>', 'default': None,
+           'validator': frontend.validate_nonnegative_int}),
+         ('Collapse the whitespace in the text outside of pre, code and '
+          'textarea tags and minify the embedded stylesheets and scripts. '
+          'Each stylesheet and script is minified once and cached.',
+          ['--minify'],
+          {'default': 0, 'action': 'store_true',
+           'validator': frontend.validate_boolean}),
+         ('Append the wall and CPU time of each phase, postprocessor and '
+          'node type as one line of JSON to <file>.',
+          ['--timing-report'],
+          {'default': None, 'metavar': '<file>'}),
+         ('Translate the top level sections of the document in N forked '
+          'processes, 0 means one per CPU. For very large documents, the '
+          'output is the same as translating them in order.',
+          ['--translate-jobs'],
+          {'metavar': '<N>', 'default': None,
+           'validator': frontend.validate_nonnegative_int}),])
 
     settings_defaults = {
         'output_encoding_error_handler': 'xmlcharrefreplace'
     }
 
     post_processors = []
+    # postprocessors that take the tag index as the index keyword argument
+    indexed_postprocessors = set()
+    # postprocessors that take the asset directory as the asset_directory
+    # keyword argument
+    asset_postprocessors = set()
 
-    def __init__(self):
+    def __init__(self, timing_callback=None):
+        """
+        ``timing_callback`` is called with the ``Timings`` of every
+        translated document, the same data ``--timing-report`` writes.
+        """
         writers.Writer.__init__(self)
         self.translator_class = HTMLTranslator
+        self.timing_callback = timing_callback
+        self.timings = None
 
     @classmethod
-    def add_postprocessor(cls, name, opt_name, processor):
+    def add_postprocessor(cls, name, opt_name, processor, indexed=False,
+                          links_assets=False):
+        """
+        Register a postprocessor enabled by --<opt_name> and configured
+        with --<opt_name>-opts. If ``indexed`` is true the processor is
+        called with the ``TagIndex`` of the translated tags as the
+        ``index`` keyword argument. If ``links_assets`` is true it's called
+        with the ``AssetDirectory`` of --asset-dir, or None, as the
+        ``asset_directory`` keyword argument.
+        """
         opt_switch = '--' + opt_name.replace("_", "-")
         opt_switch_params = opt_switch + "-opts"
         opt_params_name = opt_name + "_opts"
@@ -215,10 +313,134 @@ class Writer(writers.Writer):
 
         cls.post_processors.append((opt_name, processor))
 
+        if indexed:
+            cls.indexed_postprocessors.add(opt_name)
+
+        if links_assets:
+            cls.asset_postprocessors.add(opt_name)
+
+    def write(self, document, destination):
+        settings = document.settings
+        path = getattr(destination, 'destination_path', None)
+
+        streamed = settings.stream_output or settings.precompress
+
+        if not (streamed and path and
+                isinstance(destination, FileOutput) and
+                destination.destination is None):
+            return writers.Writer.write(self, document, destination)
+
+        self.document = document
+        self.language = languages.get_language(settings.language_code,
+                                               document.reporter)
+        self.destination = destination
+        self.output = None
+
+        # without postprocessors the translated sections aren't looked at
+        # again, they wait in a temporary file instead of in memory
+        with tempfile.TemporaryFile() as spool:
+            if settings.stream_output and not self.postprocessors_enabled():
+                tree = self.build_tree(spool)
+            else:
+                tree = self.build_tree()
+
+            with (self.timings or NULL_TIMINGS).phase('serialize'):
+                # the compressed copies are written from the same chunks
+                with compress.Output(path, settings.precompress or (),
+                                     settings.compression_level) as out:
+                    writer = ChunkWriter(
+                        out.write, settings.output_encoding,
+                        settings.output_encoding_error_handler)
+                    self.serialize(tree, writer.write)
+                    writer.close()
+
+        self.report_timings()
+
+    def serialize(self, tree, write):
+        """
+        Serialize the tree returned by ``build_tree`` calling ``write`` with
+        each chunk of the output.
+        """
+        settings = self.document.settings
+
+        if settings.emit_body:
+            for i, child in enumerate(tree[1]):
+                if i:
+                    write("\n")
+                serialize(child, write, settings.minify)
+        else:
+            write(DOCTYPE)
+            serialize(tree, write, settings.minify)
+
     def translate(self):
-        visitor = self.translator_class(self.document)
-        self.document.walkabout(visitor)
-        tree = visitor.get_tree()
+        tree = self.build_tree()
+
+        with (self.timings or NULL_TIMINGS).phase('serialize'):
+            chunks = []
+            self.serialize(tree, chunks.append)
+            self.output = "".join(chunks)
+
+        self.report_timings()
+
+    def report_timings(self):
+        """
+        Pass the timings of the last document to ``timing_callback`` and
+        write them to the ``--timing-report`` file.
+        """
+        if self.timings is None:
+            return
+
+        if self.timing_callback is not None:
+            self.timing_callback(self.timings)
+
+        if self.document.settings.timing_report:
+            self.timings.write(self.document.settings.timing_report)
+
+    def postprocessors_enabled(self):
+        "return True if a postprocessor is enabled for the document"
+        settings = self.document.settings
+        return any(getattr(settings, key) for (key, _) in self.post_processors)
+
+    def build_tree(self, spool=None):
+        """
+        Translate the document and run the enabled postprocessors, return
+        the resulting ``Html`` tag.
+
+        The files read on the way are added to the ``record_dependencies``
+        setting. If ``spool``, a binary file, is given the top level
+        sections are written there as soon as they are translated and
+        their tags and doctree are freed, only when no postprocessor is
+        enabled.
+        """
+        settings = self.document.settings
+
+        if settings.timing_report or self.timing_callback is not None:
+            self.timings = Timings(getattr(settings, '_source', None))
+        else:
+            self.timings = None
+
+        with assets.recording(settings.record_dependencies):
+            return self._build_tree(spool)
+
+    def _build_tree(self, spool=None):
+        timings = self.timings or NULL_TIMINGS
+
+        if self.timings is None:
+            visitor = self.translator_class(self.document)
+        else:
+            visitor = timed_translator(self.translator_class)(self.document)
+            visitor.timings = self.timings
+
+        with timings.phase('translate'):
+            jobs = self.document.settings.translate_jobs
+            if jobs is not None and jobs != 1:
+                # without postprocessors nothing looks into the sections
+                visitor.sections = parallel.translate_sections(
+                    self.translator_class, self.document, jobs,
+                    not self.postprocessors_enabled())
+            visitor.spool = spool
+            visitor.walkabout(self.document)
+            tree = visitor.get_tree()
 
         settings = self.document.settings
         embed = settings.embed_content
@@ -229,45 +451,27 @@ class Writer(writers.Writer):
 
         for (key, processor) in Writer.post_processors:
             if getattr(settings, key):
+                params = get_postprocessor_params(settings, key)
+                kwargs = {}
+                if key in Writer.indexed_postprocessors:
+                    kwargs['index'] = visitor.index
+                if key in Writer.asset_postprocessors:
+                    kwargs['asset_directory'] = visitor.asset_directory
 
-                params_str = getattr(settings, key + "_opts") or ""
-                pairs = []
-
-                for keyval in params_str.split(","):
-                    if "=" not in keyval:
-                        continue
-                    key, val = keyval.split("=", 1)
-                    parsed_val = parse_param_value(val)
-                    pairs.append((key, parsed_val))
-
-                params = {}
-                # a key that appears more than once is converted into a list
-                # of the found values
-                for key, val in pairs:
-                    if key in params:
-                        current_val = params[key]
-
-                        if isinstance(current_val, list):
-                            current_val.append(val)
-                        else:
-                            params[key] = [current_val, val]
-                    else:
-                        params[key] = val
-
-                processor(tree, embed, params)
+                with timings.postprocessor(key):
+                    processor(tree, embed, params, **kwargs)
 
         # tell the visitor to append the default stylesheets
         # we call it after the postprocessors to make sure it haves precedence
-        visitor.append_default_stylesheets()
+        with timings.phase('stylesheets'):
+            visitor.append_default_stylesheets()
 
-        if settings.emit_body:
-            self.output = "\n".join([str(child) for child in tree[1]])
-        else:
-            self.output = DOCTYPE
-            self.output += str(tree)
+        return tree
 
 for (key, data) in postprocessors.PROCESSORS:
-    Writer.add_postprocessor(data["name"], key, data["processor"])
+    Writer.add_postprocessor(data["name"], key, data["processor"],
+                             data.get("indexed", False),
+                             data.get("links_assets", False))
 
 
 def docinfo_address(node, translator):
@@ -307,8 +511,11 @@ def classifier(node, translator):
 
     new_current = Span(class_="classifier")
 
-    term.append(Span(" :", class_="classifier-delimiter"))
+    delimiter = Span(" :", class_="classifier-delimiter")
+    term.append(delimiter)
     term.append(new_current)
+    translator.index.add(delimiter)
+    translator.index.add(new_current)
 
     return new_current
 
@@ -343,14 +550,30 @@ def admonition(node, translator):
 
     return div
 
+def comment(node, translator):
+    tag = Comment()
+    translator._append(tag, node)
+    return tag
+
 def skip(node, translator):
     return translator.current
 
 def swallow_childs(node, translator):
-    return Span(class_="remove-me")
+    # the children never reach the tree, they aren't translated so the
+    # postprocessors don't find their tags in the index
+    raise nodes.SkipNode
 
 def raw(node, translator):
-    tags = html_to_tags(node.astext())
+    if 'html' not in node.get('format', '').split():
+        # content for other writers, like latex, is left out
+        raise nodes.SkipNode
+
+    if node.get('classes') or node.get('ids'):
+        # the attributes are set on the first tag
+        tags = html_to_tags(node.astext())
+    else:
+        # written verbatim, parsed only if a postprocessor looks into it
+        tags = [Fragment(node.astext())]
     for tag in tags:
         translator._append(tag, node)
     node.children[:] = []
@@ -395,7 +618,7 @@ NODES = {
     "citation_reference": None,
     "classifier": classifier,
     "colspec": skip,
-    "comment": lambda node, _: Comment(node),
+    "comment": comment,
     "compound": None,
     "container": None,
     "decoration": skip,
@@ -464,10 +687,63 @@ NODES = {
     "system_message": None,
 }
 
+_UNKNOWN_VISITORS = {}
+
+def unknown_visitor(nodename):
+    """
+    Return a function(translator, node) that visits the nodes named
+    nodename as described in ``NODES``, created once per name.
+    """
+    visit = _UNKNOWN_VISITORS.get(nodename)
+    if visit is not None:
+        return visit
+
+    handler = NODES.get(nodename, None)
+
+    if isinstance(handler, tuple):
+        tag_class, cls = handler
+
+        def visit(translator, node):
+            translator._stack(tag_class(class_=cls), node)
+    elif type(handler) == type and issubclass(handler, TagBase):
+        def visit(translator, node):
+            translator._stack(handler(), node)
+    elif callable(handler):
+        def visit(translator, node):
+            translator._stack(handler(node, translator), node, False)
+    else:
+        def visit(translator, node):
+            known_attributes = translator.get_known_attributes(node)
+            translator._stack(Div(**known_attributes), node)
+
+    _UNKNOWN_VISITORS[nodename] = visit
+    return visit
+
+# translator class -> ({node class: visit}, {node class: depart})
+_DISPATCH_TABLES = {}
+
 class HTMLTranslator(nodes.NodeVisitor):
     def __init__(self, document):
         nodes.NodeVisitor.__init__(self, document)
+        # the visit and depart function of each node class, resolved on
+        # the first node of the class, None to let docutils dispatch and
+        # log each call when debugging
+        if document.reporter.debug_flag:
+            self._visitors = self._departures = None
+        else:
+            tables = _DISPATCH_TABLES.get(self.__class__)
+            if tables is None:
+                tables = _DISPATCH_TABLES[self.__class__] = ({}, {})
+            self._visitors, self._departures = tables
+
         self.root = Body()
+        # top level sections translated in parallel, by id of the node
+        self.sections = None
+        # binary file where the top level sections are written once closed
+        self.spool = None
+        # tags by name and class for the postprocessors
+        self.index = TagIndex()
+        self.index.add(self.root)
         self.indent = 1
         self.parents = []
         self.current = self.root
@@ -484,6 +760,8 @@ class HTMLTranslator(nodes.NodeVisitor):
 
         # make settings for this
         self.content_type = self.settings.output_encoding
+        self.asset_directory = assets.AssetDirectory.from_settings(
+            self.settings)
 
         self.head = Head(
             Meta(charset=self.content_type),
@@ -501,12 +779,15 @@ class HTMLTranslator(nodes.NodeVisitor):
         option = fields[1] if len(fields) > 1 else None
         if name == 'html':
             option = self.settings.math_css or option
-            self.math_handler = HTMLMathHandler(css_filename=option)
+            self.math_handler = HTMLMathHandler(
+                css_filename=option,
+                cache_dir=self.settings.math_cache_dir)
         elif name == 'mathml':
             if option:
                 raise ValueError(('Math handler "%s" does not support ' +
                                  'option "%s".') % (name, option))
-            self.math_handler = MathMLMathHandler()
+            self.math_handler = MathMLMathHandler(
+                cache_dir=self.settings.math_cache_dir)
         elif name == 'mathjax':
             # The MathJax handler can be configured via different ways:
             #
@@ -548,16 +829,19 @@ class HTMLTranslator(nodes.NodeVisitor):
         """
         Link/embed CSS file.
         """
-        if self.settings.embed_content:
-            content = codecs.open(path, 'r', encoding='utf8').read()
-            tag = Style(content, type="text/css")
+        if self.asset_directory is not None:
+            tag = Link(href=self.asset_directory.link(path), rel="stylesheet",
+                       type_="text/css")
+        elif self.settings.embed_content:
+            tag = Style(assets.read(path), type="text/css")
         else:
             tag = Link(href=path, rel="stylesheet", type_="text/css")
         self.head.append(tag)
 
     def js(self, path):
-        content = open(path).read().decode('utf-8')
-        return Script(content)
+        if self.asset_directory is not None:
+            return Script(src=self.asset_directory.link(path))
+        return Script(assets.read(path))
 
     def get_tree(self):
         return Html(self.head, self.root)
@@ -618,6 +902,7 @@ class HTMLTranslator(nodes.NodeVisitor):
                 tag.append(Span(id=id))
 
         tag.attrib.update(atts)
+        self.index.add(tag)
 
     def pop_parent(self, node):
         self.current = self.parents.pop()
@@ -701,10 +986,56 @@ class HTMLTranslator(nodes.NodeVisitor):
         self.pop_parent(node)
 
     def visit_section(self, node):
+        if self.sections is not None and id(node) in self.sections:
+            self._merge_section(self.sections.pop(id(node)))
+            raise nodes.SkipNode
+
         self.title_level += 1
         self._stack(Section(), node)
 
-    depart_section = depart_topic
+    def _merge_section(self, result):
+        "append a section translated by parallel.translate_sections"
+        tags, math_used, dependencies = result
+
+        if math_used and not self.math_handler._setup_done:
+            self.math_handler._setup(self)
+            self.math_handler._setup_done = True
+
+        for tag in tags:
+            self.current.append(tag)
+            self.index.add(tag)
+
+        for path in dependencies:
+            assets.record(path)
+
+    def depart_section(self, node):
+        self.depart_topic(node)
+
+        if self.spool is not None and self.current is self.root:
+            self._spool_section(node)
+
+    def _spool_section(self, node):
+        """
+        Write the top level section just closed to the spool, free its tags
+        and the doctree below it.
+        """
+        spool = self.spool
+        spool.seek(0, os.SEEK_END)
+        offset = spool.tell()
+        writer = ChunkWriter(spool.write, 'utf-8')
+        serialize(self.root[-1], writer.write, self.settings.minify)
+        writer.close()
+
+        self.root[-1] = SpooledFragment(spool, offset, spool.tell() - offset)
+        # without postprocessors the index isn't queried
+        self.index = TagIndex()
+
+        stack = [node]
+        while stack:
+            children = stack.pop().children
+            stack.extend(children)
+            if isinstance(children, list):
+                del children[:]
 
     def visit_document(self, node):
         #self.head[1].text = node.get('title', 'document')
@@ -824,18 +1155,16 @@ class HTMLTranslator(nodes.NodeVisitor):
         if 'height' in node:
             atts['height'] = node['height']
         if 'scale' in node:
-            if Image and not ('width' in node and 'height' in node):
-                try:
-                    im = Image.open(str(uri))
-                except (IOError, # Source image can't be found or opened
-                        UnicodeError):  # PIL doesn't like Unicode paths.
-                    pass
-                else:
+            if not ('width' in node and 'height' in node):
+                from . import imagesize
+                # None if the image can't be found or read
+                size = imagesize.get_size(uri)
+                if size is not None:
+                    assets.record(uri)
                     if 'width' not in atts:
-                        atts['width'] = str(im.size[0])
+                        atts['width'] = str(size[0])
                     if 'height' not in atts:
-                        atts['height'] = str(im.size[1])
-                    del im
+                        atts['height'] = str(size[1])
             for att_name in 'width', 'height':
                 if att_name in atts:
                     match = re.match(r'([0-9.]+)(\S*)$', atts[att_name])
@@ -878,24 +1207,7 @@ class HTMLTranslator(nodes.NodeVisitor):
         self._stack(tag, node)
 
     def unknown_visit(self, node):
-        nodename = node.__class__.__name__
-
-        handler = NODES.get(nodename, None)
-        already_inserted = False
-
-        if isinstance(handler, tuple):
-            tag_class, cls = handler
-            new_current = tag_class(class_=cls)
-        elif type(handler) == type and issubclass(handler, TagBase):
-            new_current = handler()
-        elif callable(handler):
-            new_current = handler(node, self)
-            already_inserted = True
-        else:
-            known_attributes = self.get_known_attributes(node)
-            new_current = Div(**known_attributes)
-
-        self._stack(new_current, node, not already_inserted)
+        unknown_visitor(node.__class__.__name__)(self, node)
 
     def get_known_attributes(self, node):
         attrs = {}
@@ -908,3 +1220,77 @@ class HTMLTranslator(nodes.NodeVisitor):
 
     unknown_departure = pop_parent
     depart_reference = pop_parent
+
+    def dispatch_visit(self, node):
+        visitors = self._visitors
+        if visitors is None:
+            return nodes.NodeVisitor.dispatch_visit(self, node)
+
+        node_class = node.__class__
+        visit = visitors.get(node_class)
+        if visit is None:
+            cls = self.__class__
+            visit = getattr(cls, 'visit_' + node_class.__name__, None)
+            if visit is None:
+                if cls.unknown_visit == HTMLTranslator.unknown_visit:
+                    visit = unknown_visitor(node_class.__name__)
+                else:
+                    visit = cls.unknown_visit
+            visitors[node_class] = visit
+
+        return visit(self, node)
+
+    def dispatch_departure(self, node):
+        departures = self._departures
+        if departures is None:
+            return nodes.NodeVisitor.dispatch_departure(self, node)
+
+        node_class = node.__class__
+        depart = departures.get(node_class)
+        if depart is None:
+            depart = departures[node_class] = getattr(
+                self.__class__, 'depart_' + node_class.__name__,
+                self.__class__.unknown_departure)
+
+        return depart(self, node)
+
+    def walkabout(self, node):
+        """
+        Translate node and its descendants like ``node.walkabout(self)``,
+        without the debug messages docutils formats for every node even
+        when they aren't shown.
+        """
+        if self._visitors is None:
+            return node.walkabout(self)
+
+        call_depart = True
+        stop = False
+
+        try:
+            try:
+                self.dispatch_visit(node)
+            except nodes.SkipNode:
+                return stop
+            except nodes.SkipDeparture:
+                call_depart = False
+
+            try:
+                for child in node.children[:]:
+                    if self.walkabout(child):
+                        stop = True
+                        break
+            except nodes.SkipSiblings:
+                pass
+        except nodes.SkipChildren:
+            pass
+        except nodes.StopTraversal:
+            stop = True
+
+        if call_depart:
+            self.dispatch_departure(node)
+
+        return stop
+
+
+# the renderer uses the Writer defined above
+from .renderer import Renderer
@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""
+Process wide cache for the css and js files used by ``html5css3``.
+
+Every embedded stylesheet and script goes through ``read``, files are read
+from disk only the first time or after they changed. The cache is bounded,
+the least recently used files are evicted first.
+
+Instead of embedding them the files can be copied to an ``AssetDirectory``
+under a name with the hash of their content, so pages link to them and
+browsers cache them forever.
+"""
+
+from __future__ import absolute_import
+
+import contextlib
+import hashlib
+import io
+import os
+import threading
+from collections import OrderedDict
+
+from docutils import utils
+
+
+# maximum number of characters kept in the default cache
+DEFAULT_MAX_SIZE = 32 * 1024 * 1024
+
+
+def _read_text(path):
+    with io.open(path, encoding='utf-8') as f:
+        return f.read()
+
+
+class AssetCache(object):
+    """
+    Cache of decoded text files, or any string computed from a file, keyed
+    by path and invalidated by mtime.
+    """
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE):
+        self.max_size = max_size
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def read(self, path):
+        "return the content of the utf-8 encoded file at path"
+        return self.get(path, _read_text)
+
+    def get(self, path, load):
+        """
+        Return ``load(path)``, only calling it again when the file at path
+        changed. ``load`` must return a string, or a value measured by
+        ``_size`` in subclasses.
+        """
+        stat = os.stat(path)
+        key = os.path.abspath(path)
+        version = (stat.st_mtime, stat.st_size)
+
+        with self._lock:
+            entry = self._entries.pop(key, None)
+
+            if entry is not None:
+                if entry[0] == version:
+                    # reinsert to mark it as the most recently used
+                    self._entries[key] = entry
+                    return entry[1]
+
+                self.size -= self._size(entry[1])
+
+        content = load(path)
+        self._store(key, (version, content))
+        return content
+
+    def _size(self, content):
+        "size of content counted against max_size"
+        return len(content)
+
+    def _lookup(self, key):
+        """
+        Return the content stored under key marking it as the most recently
+        used, None if it's not cached.
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+
+            if entry is None:
+                return None
+
+            self._entries[key] = entry
+            return entry[1]
+
+    def _store(self, key, entry):
+        size = self._size(entry[1])
+
+        if size > self.max_size:
+            return
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= self._size(old[1])
+
+            self._entries[key] = entry
+            self.size += size
+
+            while self.size > self.max_size:
+                _, (_, content) = self._entries.popitem(last=False)
+                self.size -= self._size(content)
+
+    def clear(self):
+        "remove all the entries"
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, path):
+        return os.path.abspath(path) in self._entries
+
+
+CACHE = AssetCache()
+
+_recorders = threading.local()
+
+
+@contextlib.contextmanager
+def recording(dependencies):
+    """
+    Add the paths of the files used in this thread to ``dependencies`` (a
+    ``docutils.utils.DependencyList``) until the block exits.
+    """
+    stack = _recorders.__dict__.setdefault('stack', [])
+    stack.append(dependencies)
+    try:
+        yield dependencies
+    finally:
+        stack.pop()
+
+
+def record(path):
+    "record path as a dependency of the document being rendered"
+    stack = getattr(_recorders, 'stack', None)
+    if stack and stack[-1] is not None:
+        stack[-1].add(path)
+
+
+def read(path):
+    "return the content of path using the process wide cache"
+    record(path)
+    return CACHE.read(path)
+
+
+def write_atomic(path, content):
+    """
+    Write the bytes in content to path, creating its directory. The file
+    is written next to path and renamed, so other threads and processes
+    never read a partial file.
+    """
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # created by another process meanwhile
+            if not os.path.isdir(directory):
+                raise
+
+    tmp_path = '%s.%d.%d.tmp' % (path, os.getpid(),
+                                 threading.current_thread().ident)
+    with open(tmp_path, 'wb') as f:
+        f.write(content)
+    os.rename(tmp_path, path)
+
+
+# (directory, path, mtime, size) -> name of the copy in the directory
+_published = {}
+_published_lock = threading.Lock()
+
+
+class AssetDirectory(object):
+    """
+    Directory where the assets of the documents are copied once, named
+    after the hash of their content, instead of being embedded.
+
+    ``url`` is the URL of the directory used in the links, by default the
+    path of the directory relative to ``destination``, the output file.
+    """
+
+    def __init__(self, path, url=None, destination=None):
+        self.path = os.path.abspath(path)
+        self.url = url
+        self.destination = destination
+
+    @classmethod
+    def from_settings(cls, settings):
+        "return the asset directory of the settings or None"
+        path = getattr(settings, 'asset_dir', None)
+        if not path:
+            return None
+
+        return cls(path, settings.asset_url,
+                   getattr(settings, '_destination', None))
+
+    def publish(self, path):
+        "copy the file at path to the directory, return its new name"
+        record(path)
+        stat = os.stat(path)
+        key = (self.path, os.path.abspath(path), stat.st_mtime, stat.st_size)
+
+        with _published_lock:
+            name = _published.get(key)
+
+        if name is not None and os.path.exists(os.path.join(self.path, name)):
+            return name
+
+        with open(path, 'rb') as f:
+            content = f.read()
+
+        base, ext = os.path.splitext(os.path.basename(path))
+        name = '%s.%s%s' % (base, hashlib.sha1(content).hexdigest()[:16], ext)
+        target = os.path.join(self.path, name)
+
+        if not os.path.exists(target):
+            write_atomic(target, content)
+
+        with _published_lock:
+            _published[key] = name
+
+        return name
+
+    def link(self, path):
+        "copy the file at path to the directory, return the URL to link it"
+        name = self.publish(path)
+
+        if self.url:
+            return self.url.rstrip('/') + '/' + name
+
+        return utils.relative_path(self.destination,
+                                   os.path.join(self.path, name))
@@ -0,0 +1,411 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""
+Batch rendering of whole source trees for ``html5css3``.
+
+All the sources found below a directory are rendered by a pool of worker
+processes that import docutils and ``html5css3`` once and then render file
+after file, a failure in one document doesn't stop the others.
+
+Incremental builds keep a manifest with the hash of every file each output
+was built from (the source, included and raw files, images and assets) and
+of the writer settings, only the documents where one of them changed are
+rendered again. Outputs are only rewritten if their content changed.
+"""
+
+from __future__ import absolute_import
+
+import copy
+import hashlib
+import json
+import os
+import sys
+
+from docutils import SettingsSpec, frontend, io, utils
+from docutils.core import Publisher, publish_programmatically
+
+from . import Writer, compress
+
+
+SOURCE_SUFFIXES = ('.rst', '.rst.gz')
+DESTINATION_SUFFIX = '.html'
+MANIFEST_NAME = '.rst2html5-manifest.json'
+MANIFEST_VERSION = 1
+
+# settings that change for every document or don't change the output
+VOLATILE_SETTINGS = ('_source', '_destination', '_config_files',
+                     'record_dependencies', 'jobs', 'incremental',
+                     'build_manifest', 'timing_report', 'watch', 'serve',
+                     'serve_workers', 'serve_trusted', 'translate_jobs')
+
+
+class BatchOptions(SettingsSpec):
+    """
+    Command line options for batch rendering, watch mode and the render
+    service.
+    """
+    settings_spec = (
+        'Batch Options',
+        None,
+        (('Render every .rst and .rst.gz file below <source> into the same '
+          'relative path below <destination>, both must be directories. N '
+          'worker processes are used, 0 means one per CPU.',
+          ['--jobs'],
+          {'metavar': '<N>', 'default': None,
+           'validator': frontend.validate_nonnegative_int}),
+         ('With --jobs, only render the documents whose source, included '
+          'files, images, assets or settings changed since the last build.',
+          ['--incremental'],
+          {'default': 0, 'action': 'store_true',
+           'validator': frontend.validate_boolean}),
+         ('Manifest file used by --incremental. Default: "%s" in the '
+          'destination directory.' % MANIFEST_NAME,
+          ['--build-manifest'],
+          {'metavar': '<file>', 'default': None}),
+         ('Keep running and render <source> again into <destination> when '
+          'it, the files it includes or the assets it uses change. <source> '
+          'can be a directory like with --jobs.',
+          ['--watch'],
+          {'default': 0, 'action': 'store_true',
+           'validator': frontend.validate_boolean}),),
+        'Server Options',
+        None,
+        (('Run a render service on <address> instead of rendering files: '
+          '"<port>" (on 127.0.0.1) or "<host>:<port>" for HTTP, '
+          '"unix:<path>" for a Unix socket. POST the source to /render, see '
+          'html5css3.server.',
+          ['--serve'],
+          {'metavar': '<address>', 'default': None}),
+         ('Number of requests --serve renders concurrently. Default: one '
+          'per CPU.',
+          ['--serve-workers'],
+          {'metavar': '<N>', 'default': None,
+           'validator': frontend.validate_nonnegative_int}),
+         ('Let the documents sent to --serve include files and raw '
+          'content. Only for trusted clients, they can read any file the '
+          'server can.',
+          ['--serve-trusted'],
+          {'default': 0, 'action': 'store_true',
+           'validator': frontend.validate_boolean}),))
+
+
+def get_settings(**defaults):
+    """
+    Return the default settings of the ``html5css3`` writer.
+
+    Keyword arguments override the defaults.
+    """
+    pub = Publisher(writer=Writer())
+    pub.set_components('standalone', 'restructuredtext', 'html5')
+    return pub.get_settings(**defaults)
+
+
+def find_sources(source_dir, destination_dir):
+    """
+    Yield (source path, destination path) for every source below
+    ``source_dir``.
+    """
+    for dirpath, dirnames, filenames in os.walk(source_dir):
+        dirnames.sort()
+        relpath = os.path.relpath(dirpath, source_dir)
+
+        for filename in sorted(filenames):
+            for suffix in SOURCE_SUFFIXES:
+                if filename.endswith(suffix):
+                    name = filename[:-len(suffix)] + DESTINATION_SUFFIX
+                    yield (os.path.join(dirpath, filename),
+                           os.path.normpath(
+                               os.path.join(destination_dir, relpath, name)))
+                    break
+
+
+def split_duplicates(paths):
+    """
+    Split the (source path, destination path) of ``find_sources`` into the
+    ones to render and a list of (source path, error message) for the
+    sources with the same destination as a previous one, like ``a.rst`` and
+    ``a.rst.gz``.
+    """
+    sources = {}
+    unique = []
+    duplicates = []
+
+    for source_path, destination_path in paths:
+        first = sources.get(destination_path)
+
+        if first is None:
+            sources[destination_path] = source_path
+            unique.append((source_path, destination_path))
+        else:
+            duplicates.append((source_path, '%s is also rendered from %s' % (
+                destination_path, first)))
+
+    return unique, duplicates
+
+
+def settings_hash(settings):
+    "return a hash of the settings that affect the output"
+    items = sorted((key, repr(value))
+                   for (key, value) in settings.__dict__.items()
+                   if key not in VOLATILE_SETTINGS)
+    return hashlib.sha1(repr(items).encode('utf-8')).hexdigest()
+
+
+def file_hash(path, cache=None):
+    "return the sha1 of the content of path or None if it can't be read"
+    if cache is not None and path in cache:
+        return cache[path]
+
+    sha1 = hashlib.sha1()
+    try:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(64 * 1024), b''):
+                sha1.update(chunk)
+        digest = sha1.hexdigest()
+    except (IOError, OSError):
+        digest = None
+
+    if cache is not None:
+        cache[path] = digest
+
+    return digest
+
+
+def write_if_changed(path, data):
+    "write data to path unless it already has that content"
+    try:
+        with open(path, 'rb') as f:
+            if f.read() == data:
+                return False
+    except (IOError, OSError):
+        pass
+
+    with open(path, 'wb') as f:
+        f.write(data)
+
+    return True
+
+
+class Manifest(object):
+    """
+    Record of what every output was built from.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.documents = {}
+        self._hashes = {}
+
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError):
+            return
+
+        if data.get('version') == MANIFEST_VERSION:
+            self.documents = data.get('documents', {})
+
+    def is_fresh(self, source_path, destination_path, settings_digest,
+                 formats=()):
+        """
+        Return True if the output and its copies compressed in ``formats``
+        are up to date.
+        """
+        entry = self.documents.get(os.path.abspath(destination_path))
+
+        if (entry is None or entry['source'] != os.path.abspath(source_path)
+                or entry['settings'] != settings_digest):
+            return False
+
+        for path in compress.output_paths(destination_path, formats):
+            if not os.path.exists(path):
+                return False
+
+        for path, digest in entry['dependencies'].items():
+            if file_hash(path, self._hashes) != digest:
+                return False
+
+        return True
+
+    def update(self, source_path, destination_path, settings_digest,
+               dependencies):
+        "record the files an output was built from"
+        paths = set(os.path.abspath(path) for path in dependencies)
+        paths.add(os.path.abspath(source_path))
+
+        self.documents[os.path.abspath(destination_path)] = {
+            'source': os.path.abspath(source_path),
+            'settings': settings_digest,
+            'dependencies': dict((path, file_hash(path, self._hashes))
+                                 for path in paths)
+        }
+
+    def remove(self, destination_path):
+        self.documents.pop(os.path.abspath(destination_path), None)
+
+    def save(self):
+        dirname = os.path.dirname(self.path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+        with open(self.path, 'w') as f:
+            json.dump({'version': MANIFEST_VERSION,
+                       'documents': self.documents}, f, indent=1,
+                      sort_keys=True)
+
+
+_settings = None
+
+
+def _init_worker(settings):
+    global _settings
+    _settings = settings
+
+
+def render_document(source_path, destination_path, settings, writer=None):
+    """
+    Render one document with a copy of ``settings``.
+
+    Returns a tuple with an error message or None and the list of the
+    files the output depends on.
+    """
+    settings = copy.copy(settings)
+    settings.record_dependencies = utils.DependencyList()
+    writer = writer or Writer()
+
+    if settings.stream_output or settings.precompress:
+        # the writer writes the file and its compressed copies itself
+        destination_class = io.FileOutput
+    else:
+        destination_class = io.StringOutput
+
+    try:
+        output, _ = publish_programmatically(
+            source_class=compress.FileInput, source=None,
+            source_path=source_path,
+            destination_class=destination_class, destination=None,
+            destination_path=destination_path,
+            reader=None, reader_name='standalone',
+            parser=None, parser_name='restructuredtext',
+            writer=writer, writer_name=None,
+            settings=settings, settings_spec=None,
+            settings_overrides=None, config_section=None,
+            enable_exit_status=False)
+
+        if destination_class is io.StringOutput:
+            write_if_changed(destination_path, output)
+    except Exception as error:
+        return '%s: %s' % (error.__class__.__name__, error), []
+
+    return None, list(settings.record_dependencies.list)
+
+
+def _render(paths):
+    """
+    Render one document.
+
+    Returns (source path, destination path, error message or None, list of
+    the files the output depends on).
+    """
+    source_path, destination_path = paths
+    error, dependencies = render_document(source_path, destination_path,
+                                          _settings)
+    return source_path, destination_path, error, dependencies
+
+
+def render_tree(source_dir, destination_dir, settings, jobs=None,
+                manifest_path=None):
+    """
+    Render every source below ``source_dir`` into ``destination_dir``.
+
+    ``settings`` are the docutils settings used for every document, see
+    ``get_settings``. ``jobs`` is the number of worker processes, ``None``
+    or 0 means one per CPU. If ``manifest_path`` is given the build is
+    incremental, documents that are up to date according to the manifest
+    are skipped.
+
+    Returns a tuple with the number of rendered documents, the number of
+    skipped documents and a list of (source path, error message) for the
+    documents that failed.
+    """
+    settings = copy.copy(settings)
+    # propagate errors to the worker instead of exiting the process
+    settings.traceback = True
+    settings.record_dependencies = utils.DependencyList()
+
+    paths, duplicates = split_duplicates(
+        find_sources(source_dir, destination_dir))
+    skipped = 0
+
+    if manifest_path is not None:
+        manifest = Manifest(manifest_path)
+        settings_digest = settings_hash(settings)
+        formats = settings.precompress or ()
+        stale = [(src, dst) for (src, dst) in paths
+                 if not manifest.is_fresh(src, dst, settings_digest, formats)]
+        skipped = len(paths) - len(stale)
+        paths = stale
+
+    for dirname in set(os.path.dirname(dst) for (_, dst) in paths):
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+    import multiprocessing
+
+    pool = multiprocessing.Pool(jobs or None, _init_worker, (settings,))
+    failures = list(duplicates)
+
+    try:
+        for result in pool.imap_unordered(_render, paths):
+            source_path, destination_path, error, dependencies = result
+
+            if error is not None:
+                failures.append((source_path, error))
+
+            if manifest_path is None:
+                continue
+            elif error is None:
+                manifest.update(source_path, destination_path,
+                                settings_digest, dependencies)
+            else:
+                manifest.remove(destination_path)
+    finally:
+        pool.close()
+        pool.join()
+
+    if manifest_path is not None:
+        manifest.save()
+
+    failures.sort()
+    return len(paths) + len(duplicates) - len(failures), skipped, failures
+
+
+def run(settings, stream=None):
+    """
+    Batch render from parsed command line settings, return the exit status.
+    """
+    stream = stream or sys.stderr
+    source_dir = settings._source
+    destination_dir = settings._destination
+
+    if not (source_dir and destination_dir and os.path.isdir(source_dir)):
+        stream.write('--jobs needs a source directory and a destination '
+                     'directory\n')
+        return 2
+
+    manifest_path = None
+    if settings.incremental:
+        manifest_path = (settings.build_manifest or
+                         os.path.join(destination_dir, MANIFEST_NAME))
+
+    rendered, skipped, failures = render_tree(
+        source_dir, destination_dir, settings, settings.jobs, manifest_path)
+
+    for source_path, error in failures:
+        stream.write('%s: %s\n' % (source_path, error))
+
+    stream.write('%d rendered, %d up to date, %d failed\n' % (
+        rendered, skipped, len(failures)))
+
+    return 1 if failures else 0
@@ -0,0 +1,403 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""
+Benchmarks for ``html5css3``.
+
+Renders a corpus made of ``examples/``, the bundled ``docs/`` tree and
+synthetic documents, timing each phase separately: docutils parsing, the
+``HTMLTranslator`` walk, the default stylesheets, every postprocessor and
+the serialization. The report is written as JSON so runs can be compared
+between releases::
+
+    python -m html5css3.benchmark --output bench.json
+
+With ``--startup`` it measures the cold start of the ``rst2html5`` entry
+point instead, running it in new interpreters under ``python -X importtime``
+to report the wall time and the modules that take longest to import.
+"""
+
+from __future__ import absolute_import, print_function
+
+import argparse
+import copy
+import json
+import os
+import platform
+import subprocess
+import sys
+import timeit
+
+import docutils
+from docutils.core import publish_doctree
+
+from . import Writer, assets, batch, get_postprocessor_params, html, math
+from . import postprocessors
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+BASE_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CORPUS_DIRS = ('examples', 'docs')
+CORPUS_SUFFIXES = ('.rst', '.txt')
+
+SETTINGS = {
+    '_disable_config': True,
+    'report_level': 5,
+    'halt_level': 5,
+    'traceback': True,
+    'embed_content': True,
+}
+
+# starts the entry point as far as parsing the command line
+STARTUP_SCRIPT = ('import sys; from html5css3.main import main; '
+                  'sys.argv = ["rst2html5", "--version"]; main()')
+# number of modules listed in the start-up report
+STARTUP_MODULES = 15
+
+SYNTHETIC_SECTION = """\
+Section %(i)d
+============%(underline)s
+
+Some *emphasis*, **strong** text, ``inline literals`` and a link_ to
+somewhere else, followed by a footnote [#]_ and more text to wrap.
+
+.. [#] The footnote %(i)d.
+
+* first item with *emphasis*
+* second item with ``code``
+
+  * nested item
+
+#. enumerated
+#. list
+
+=====  =====  ======
+A      B      A or B
+=====  =====  ======
+False  False  False
+True   False  True
+=====  =====  ======
+
+.. code-block:: python
+
+    def section_%(i)d(x):
+        return x * %(i)d
+
+Inline math :math:`x_%(i)d^2 + \\frac{a}{b}` and block math:
+
+.. math::
+
+    \\sum_{i=1}^{%(i)d} i^2
+
+.. note::
+
+   An admonition with a paragraph.
+
+"""
+
+
+def synthetic_document(sections):
+    "return a synthetic document with the given number of sections"
+    parts = ['Synthetic\n=========\n\n']
+    for i in range(sections):
+        parts.append(SYNTHETIC_SECTION % {
+            'i': i, 'underline': '=' * len(str(i))})
+    parts.append('.. _link: http://example.com\n')
+    return ''.join(parts)
+
+
+def corpus(base_path=BASE_PATH, synthetic=(20, 300)):
+    """
+    Yield (name, source, source path, settings overrides) for every
+    document in the corpus.
+    """
+    for dirname in CORPUS_DIRS:
+        for dirpath, dirnames, filenames in os.walk(
+                os.path.join(base_path, dirname)):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                if filename.endswith(CORPUS_SUFFIXES):
+                    path = os.path.join(dirpath, filename)
+                    with open(path, 'rb') as f:
+                        source = f.read().decode('utf-8', 'replace')
+                    yield (os.path.relpath(path, base_path), source, path, {})
+
+    for sections in synthetic:
+        source = synthetic_document(sections)
+        yield ('synthetic-%d' % sections, source, None, {})
+        yield ('synthetic-%d-math-html' % sections, source, None,
+               {'math_output': 'html'})
+
+
+def clear_caches():
+    "empty the caches so the first run of a document is a cold one"
+    assets.CACHE.clear()
+    math.CACHE.clear()
+    postprocessors._highlighted.clear()
+
+
+def _timer(timings, name, function, *args):
+    start = timeit.default_timer()
+    result = function(*args)
+    timings.setdefault(name, []).append(timeit.default_timer() - start)
+    return result
+
+
+def _summary(times):
+    return {'first': times[0], 'best': min(times),
+            'mean': sum(times) / len(times)}
+
+
+def _render(source, source_path, settings, timings=None):
+    if timings is None:
+        timings = {}
+
+    def parse():
+        return publish_doctree(source, source_path=source_path,
+                               settings=copy.copy(settings))
+
+    document = _timer(timings, 'parse', parse)
+
+    writer = Writer()
+    writer.document = document
+
+    def translate():
+        visitor = writer.translator_class(document)
+        visitor.walkabout(document)
+        return visitor, visitor.get_tree()
+
+    visitor, tree = _timer(timings, 'translate', translate)
+    _timer(timings, 'stylesheets', visitor.append_default_stylesheets)
+
+    def serialize():
+        chunks = []
+        html.serialize(tree, chunks.append)
+        return html.DOCTYPE + ''.join(chunks)
+
+    output = _timer(timings, 'serialize', serialize)
+    return tree, output
+
+
+def run_document(source, source_path=None, settings=None, repeat=3):
+    """
+    Benchmark one document, return a dict with the timings of each phase in
+    seconds, the sizes, the throughput and the peak memory in bytes.
+    """
+    if settings is None:
+        settings = batch.get_settings(**SETTINGS)
+
+    clear_caches()
+    timings = {}
+    processors = {}
+
+    for _ in range(repeat):
+        tree, output = _render(source, source_path, settings, timings)
+
+        for (key, processor) in Writer.post_processors:
+            params = get_postprocessor_params(settings, key)
+            processed = copy.deepcopy(tree)
+            args = (processed, settings.embed_content, params)
+
+            if key in Writer.indexed_postprocessors:
+                # the translator builds it while creating the tree
+                index = html.TagIndex.from_tree(processed[1])
+                function = lambda *args: processor(*args, index=index)
+            else:
+                function = processor
+
+            try:
+                _timer(timings, key, function, *args)
+            except Exception as error:
+                processors[key] = {
+                    'error': '%s: %s' % (error.__class__.__name__, error)}
+
+    phases = dict((name, _summary(timings[name]))
+                  for name in ('parse', 'translate', 'stylesheets',
+                               'serialize'))
+
+    for (key, _) in Writer.post_processors:
+        if key not in processors:
+            processors[key] = _summary(timings[key])
+
+    seconds = sum(phase['best'] for phase in phases.values())
+    source_bytes = len(source.encode('utf-8'))
+    output_bytes = len(output.encode('utf-8'))
+
+    peak_memory = None
+    if tracemalloc is not None:
+        tracemalloc.start()
+        try:
+            _render(source, source_path, settings)
+            peak_memory = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    return {
+        'phases': phases,
+        'postprocessors': processors,
+        'seconds': seconds,
+        'source_bytes': source_bytes,
+        'output_bytes': output_bytes,
+        'bytes_per_second': source_bytes / seconds if seconds else None,
+        'peak_memory': peak_memory,
+    }
+
+
+def run(documents, repeat=3, stream=None):
+    """
+    Benchmark (name, source, source path, settings overrides) documents,
+    return the report.
+    """
+    results = []
+    total_seconds = total_source = total_output = 0
+
+    for name, source, source_path, overrides in documents:
+        if stream is not None:
+            stream.write('%s\n' % name)
+
+        settings = batch.get_settings(**dict(SETTINGS, **overrides))
+        try:
+            result = run_document(source, source_path, settings, repeat)
+        except Exception as error:
+            result = {'error': '%s: %s' % (error.__class__.__name__, error)}
+        else:
+            total_seconds += result['seconds']
+            total_source += result['source_bytes']
+            total_output += result['output_bytes']
+
+        result['name'] = name
+        results.append(result)
+
+    return {
+        'python': '%s %s' % (platform.python_implementation(),
+                             platform.python_version()),
+        'docutils': docutils.__version__,
+        'platform': platform.platform(),
+        'repeat': repeat,
+        'documents': results,
+        'total': {
+            'seconds': total_seconds,
+            'source_bytes': total_source,
+            'output_bytes': total_output,
+            'bytes_per_second': (total_source / total_seconds
+                                 if total_seconds else None),
+        },
+    }
+
+
+def parse_importtime(output):
+    """
+    Return a dict of module name to (self, cumulative) import time in
+    seconds from the ``-X importtime`` output.
+    """
+    modules = {}
+
+    for line in output.splitlines():
+        if not line.startswith('import time:'):
+            continue
+
+        parts = line[len('import time:'):].split('|')
+        if len(parts) != 3 or not parts[0].strip().isdigit():
+            # the header
+            continue
+
+        name = parts[2].strip()
+        modules[name] = (int(parts[0]) / 1e6, int(parts[1]) / 1e6)
+
+    return modules
+
+
+def startup(repeat=3, script=STARTUP_SCRIPT):
+    """
+    Run the entry point ``repeat`` times in new interpreters, return the
+    wall times and the import times of the run with the fastest start.
+    """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        path for path in (BASE_PATH, env.get('PYTHONPATH')) if path)
+    command = [sys.executable, '-X', 'importtime', '-c', script]
+
+    def start():
+        begin = timeit.default_timer()
+        process = subprocess.Popen(command, env=env, stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+        _, err = process.communicate()
+        elapsed = timeit.default_timer() - begin
+
+        if process.returncode != 0:
+            raise RuntimeError(err.decode('utf-8', 'replace'))
+
+        return elapsed, parse_importtime(err.decode('utf-8', 'replace'))
+
+    # the first run may compile the modules to bytecode
+    start()
+    runs = [start() for _ in range(repeat)]
+    times = [elapsed for (elapsed, _) in runs]
+    modules = min(runs, key=lambda run: run[0])[1]
+    slowest = sorted(modules.items(), key=lambda item: -item[1][0])
+
+    return {
+        'python': '%s %s' % (platform.python_implementation(),
+                             platform.python_version()),
+        'docutils': docutils.__version__,
+        'repeat': repeat,
+        'wall': _summary(times),
+        'imports': sum(self_time for (self_time, _) in modules.values()),
+        'html5css3': dict(
+            (name, cumulative) for (name, (_, cumulative)) in modules.items()
+            if name.split('.')[0] == 'html5css3'),
+        'slowest': [{'module': name, 'self': self_time,
+                     'cumulative': cumulative}
+                    for (name, (self_time, cumulative))
+                    in slowest[:STARTUP_MODULES]],
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark html5css3 over examples/, docs/ and '
+                    'synthetic documents.')
+    parser.add_argument('paths', nargs='*',
+                        help='benchmark these files instead of the corpus')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs per document (default: 3)')
+    parser.add_argument('--output', help='write the JSON report here')
+    parser.add_argument('--no-synthetic', action='store_true',
+                        help='skip the synthetic documents')
+    parser.add_argument('--quiet', action='store_true',
+                        help="don't print the documents being benchmarked")
+    parser.add_argument('--startup', action='store_true',
+                        help='measure the start up of rst2html5 instead')
+    args = parser.parse_args(argv)
+
+    if args.startup:
+        report = startup(args.repeat)
+    else:
+        if args.paths:
+            documents = []
+            for path in args.paths:
+                with open(path, 'rb') as f:
+                    documents.append(
+                        (path, f.read().decode('utf-8'), path, {}))
+        else:
+            documents = corpus(
+                synthetic=() if args.no_synthetic else (20, 300))
+
+        report = run(documents, args.repeat,
+                     None if args.quiet else sys.stderr)
+
+    data = json.dumps(report, indent=1, sort_keys=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(data + '\n')
+    else:
+        print(data)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""
+Compressed sources and precompressed outputs for ``html5css3``.
+
+Static servers can send the clients that accept it a ``.gz`` or ``.br``
+file found next to the page. ``Output`` writes the page and those siblings
+at the same time from the chunks of the serializer, the page is never read
+back from disk to compress it. Files whose content didn't change aren't
+replaced, so they keep their mtime.
+
+``FileInput`` reads sources compressed with gzip, like ``index.rst.gz``.
+
+The brotli format needs the ``brotli`` package, it's only imported when
+used.
+"""
+
+from __future__ import absolute_import
+
+import os
+import threading
+
+from docutils import io
+
+
+FORMATS = ('gz', 'br')
+# highest level of each format, used by default and as the limit
+MAX_LEVELS = {'gz': 9, 'br': 11}
+# bytes read at once when comparing files
+CHUNK_SIZE = 64 * 1024
+
+# replaces the target on windows too, python 2 only has rename
+_replace = getattr(os, 'replace', os.rename)
+
+
+class GzipFile(object):
+    "binary file written compressed with gzip"
+
+    def __init__(self, path, level, name=None):
+        import gzip
+
+        self.file = open(path, 'wb')
+        # no timestamp so the same page is always compressed the same way
+        self.compressor = gzip.GzipFile(name or path, 'wb', level, self.file,
+                                        mtime=0)
+
+    def write(self, data):
+        self.compressor.write(data)
+
+    def close(self):
+        try:
+            self.compressor.close()
+        finally:
+            self.file.close()
+
+
+class BrotliFile(object):
+    "binary file written compressed with brotli"
+
+    def __init__(self, path, quality):
+        import brotli
+
+        self.compressor = brotli.Compressor(quality=quality)
+        self.file = open(path, 'wb')
+
+    def write(self, data):
+        self.file.write(self.compressor.process(data))
+
+    def close(self):
+        try:
+            self.file.write(self.compressor.finish())
+        finally:
+            self.file.close()
+
+
+def check_format(format):
+    "raise an error if files can't be compressed in ``format`` here"
+    if format not in MAX_LEVELS:
+        raise ValueError('Unknown compression format "%s", use one of %s.' %
+                         (format, ', '.join(FORMATS)))
+
+    if format == 'br':
+        try:
+            import brotli
+        except ImportError:
+            raise ImportError('The br format needs the brotli package.')
+
+
+def open_compressed(path, format, level=None, name=None):
+    """
+    Open ``path`` for writing binary data compressed in ``format``, 'gz' or
+    'br'. ``level`` goes from 0 to 9 for gzip and to 11 for brotli, higher
+    levels are lowered to the highest, None means the highest. ``name`` is
+    the file name kept in the gzip header, ``path`` by default.
+    """
+    check_format(format)
+    max_level = MAX_LEVELS[format]
+    level = max_level if level is None else min(level, max_level)
+
+    if format == 'gz':
+        return GzipFile(path, level, name)
+    else:
+        return BrotliFile(path, level)
+
+
+def output_paths(path, formats=()):
+    "return path and the paths of its compressed siblings"
+    return [path] + ['%s.%s' % (path, format) for format in formats]
+
+
+def same_content(path, other_path):
+    "return True if both files exist and have the same content"
+    try:
+        if os.path.getsize(path) != os.path.getsize(other_path):
+            return False
+
+        with open(path, 'rb') as f, open(other_path, 'rb') as other:
+            while True:
+                chunk = f.read(CHUNK_SIZE)
+                if chunk != other.read(CHUNK_SIZE):
+                    return False
+                elif not chunk:
+                    return True
+    except (IOError, OSError):
+        return False
+
+
+class Output(object):
+    """
+    Binary file at ``path`` and its compressed siblings, ``path`` plus
+    ``.gz`` or ``.br`` for each of ``formats``. Everything written goes to
+    all of them.
+
+    The files are written next to their paths and only replace them when
+    closed if their content changed, unchanged pages keep their mtime.
+    """
+
+    def __init__(self, path, formats=(), level=None):
+        # fail before creating any file
+        for format in formats:
+            check_format(format)
+
+        self.paths = output_paths(path, formats)
+        self.tmp_paths = ['%s.%d.%d.tmp' % (output_path, os.getpid(),
+                                            threading.current_thread().ident)
+                          for output_path in self.paths]
+        self.files = [open(self.tmp_paths[0], 'wb')]
+
+        try:
+            for format, output_path, tmp_path in zip(
+                    formats, self.paths[1:], self.tmp_paths[1:]):
+                self.files.append(
+                    open_compressed(tmp_path, format, level, output_path))
+        except:
+            self.close(discard=True)
+            raise
+
+    def write(self, data):
+        for f in self.files:
+            f.write(data)
+
+    def close(self, discard=False):
+        """
+        Close the files and replace the ones that changed, or remove them
+        all if ``discard``.
+        """
+        files, self.files = self.files, []
+
+        for f in files:
+            f.close()
+
+        for path, tmp_path in zip(self.paths, self.tmp_paths[:len(files)]):
+            if discard or same_content(path, tmp_path):
+                os.remove(tmp_path)
+            else:
+                _replace(tmp_path, path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(discard=exc_type is not None)
+
+
+class FileInput(io.FileInput):
+    """
+    ``docutils.io.FileInput`` that decompresses the sources ending in
+    ``.gz``.
+    """
+
+    def __init__(self, source=None, source_path=None, *args, **kwargs):
+        if source is None and source_path and source_path.endswith('.gz'):
+            import gzip
+
+            try:
+                # the decoded text is read with the docutils heuristics
+                source = gzip.open(source_path, 'rb')
+            except IOError as error:
+                raise io.InputError(error.errno, error.strerror, source_path)
+
+        io.FileInput.__init__(self, source, source_path, *args, **kwargs)
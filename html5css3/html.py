@@ -1,20 +1,183 @@
 '''classes to ease the creation of html documents'''
 
+import codecs
 import xml.etree.ElementTree as ET
+import xml.etree.ElementPath as ElementPath
 import sys
 
 IS_PY3 = sys.version[0] == '3'
 
 if IS_PY3:
     unicode = str
+    intern = sys.intern
 
 
-if callable(ET.Element) and hasattr(ET, "_ElementInterface"):
-    class Element(ET._ElementInterface, object):
-        pass
-else:
-    class Element(ET.Element):
-        pass
+# shared by all the elements without attributes or children, they are
+# replaced by a real dict or list the first time they are modified
+_NO_ATTRS = {}
+_NO_CHILDREN = ()
+
+
+class Element(object):
+    """
+    Compact html node.
+
+    Implements the parts of the ElementTree element API used by the
+    translator and the postprocessors (``attrib``, ``get``, ``set``,
+    ``append``, ``remove``, ``iter``, ``find``, ``findall``...) without a
+    dict and a list for every node.
+    """
+
+    __slots__ = ('tag', '_attrib', '_children', 'text', 'tail')
+
+    def __init__(self, tag, attrib=None):
+        self.tag = tag
+        self._attrib = attrib or _NO_ATTRS
+        self._children = _NO_CHILDREN
+        self.text = None
+        self.tail = None
+
+    def __repr__(self):
+        return "<%s %r at %#x>" % (self.__class__.__name__, self.tag,
+                                   id(self))
+
+    @property
+    def attrib(self):
+        attrib = self._attrib
+        if attrib is _NO_ATTRS:
+            attrib = self._attrib = {}
+        return attrib
+
+    @attrib.setter
+    def attrib(self, attrib):
+        self._attrib = attrib
+
+    def get(self, key, default=None):
+        return self._attrib.get(key, default)
+
+    def set(self, key, value):
+        self.attrib[key] = value
+
+    def keys(self):
+        return self._attrib.keys()
+
+    def items(self):
+        return self._attrib.items()
+
+    def _children_list(self):
+        children = self._children
+        if children is _NO_CHILDREN:
+            children = self._children = []
+        return children
+
+    def __len__(self):
+        return len(self._children)
+
+    def __iter__(self):
+        return iter(self._children)
+
+    def __getitem__(self, index):
+        return self._children[index]
+
+    def __setitem__(self, index, element):
+        self._children_list()[index] = element
+
+    def __delitem__(self, index):
+        del self._children_list()[index]
+
+    def append(self, element):
+        self._children_list().append(element)
+
+    def extend(self, elements):
+        self._children_list().extend(elements)
+
+    def insert(self, index, element):
+        self._children_list().insert(index, element)
+
+    def remove(self, element):
+        children = self._children_list()
+        for i, child in enumerate(children):
+            if child is element:
+                del children[i]
+                return
+        raise ValueError("element not found")
+
+    def clear(self):
+        self._attrib = _NO_ATTRS
+        self._children = _NO_CHILDREN
+        self.text = self.tail = None
+
+    def iter(self, tag=None):
+        "iterate over this element and all its descendants in document order"
+        if tag == "*":
+            tag = None
+
+        stack = [iter((self,))]
+        while stack:
+            for elem in stack[-1]:
+                if tag is None or elem.tag == tag:
+                    yield elem
+                if elem._children:
+                    stack.append(iter(elem._children))
+                    break
+            else:
+                stack.pop()
+
+    getiterator = iter
+
+    def itertext(self):
+        for elem in self.iter():
+            if elem.tag is ET.Comment:
+                continue
+            if elem.text:
+                yield elem.text
+            for child in elem:
+                if child.tail:
+                    yield child.tail
+
+    def find(self, path, namespaces=None):
+        return ElementPath.find(self, path, namespaces)
+
+    def findall(self, path, namespaces=None):
+        return ElementPath.findall(self, path, namespaces)
+
+    def findtext(self, path, default=None, namespaces=None):
+        return ElementPath.findtext(self, path, default, namespaces)
+
+    def iterfind(self, path, namespaces=None):
+        return ElementPath.iterfind(self, path, namespaces)
+
+    def makeelement(self, tag, attrib):
+        return Element(tag, dict(attrib))
+
+    def copy(self):
+        "return a shallow copy"
+        elem = self.__class__.__new__(self.__class__)
+        elem.tag = self.tag
+        elem._attrib = dict(self._attrib) if self._attrib else _NO_ATTRS
+        elem._children = list(self._children) or _NO_CHILDREN
+        elem.text = self.text
+        elem.tail = self.tail
+        return elem
+
+    __copy__ = copy
+
+    def __deepcopy__(self, memo):
+        elem = self.copy()
+        if elem._children:
+            elem._children = [child.__deepcopy__(memo)
+                              for child in elem._children]
+        return elem
+
+    def __getstate__(self):
+        return (self.tag, self._attrib or None, self._children or None,
+                self.text, self.tail)
+
+    def __setstate__(self, state):
+        tag, attrib, children, self.text, self.tail = state
+        self.tag = tag
+        self._attrib = attrib or _NO_ATTRS
+        self._children = children or _NO_CHILDREN
 
 def quote(text):
     """encode html entities"""
@@ -35,9 +198,18 @@ def to_str(value):
         return value
     return unicode(value)
 
+def normalize_attrs(attrs):
+    """
+    Return a copy of ``attrs`` with the trailing underscores used to avoid
+    python keywords (``class_``) removed from the keys and the values
+    converted to strings.
+    """
+    return dict([(key.rstrip("_"), to_str(val))
+        for (key, val) in attrs.items()])
+
 def escape_attrs(node):
-    node.attrib = dict([(key.rstrip("_"), unicode(val))
-        for (key, val) in node.attrib.items()])
+    "normalize the attributes of node and all its descendants"
+    node.attrib = normalize_attrs(node.attrib)
 
     for child in node:
         escape_attrs(child)
@@ -45,25 +217,28 @@ def escape_attrs(node):
 class TagBase(Element):
     "base class for all tags"
 
+    __slots__ = ()
+
     SELF_CLOSING = False
     COMPACT = False
     QUOTE = True
+    # interned tag name, the lowercased class name if not set
+    TAG = None
 
     def __init__(self, childs, attrs):
         "add childs and call parent constructor"
-        tag = self.__class__.__name__.lower()
-        Element.__init__(self, tag, attrs)
+        tag = self.TAG or self.__class__.__name__.lower()
+        # attributes are normalized once here, values set later are
+        # converted to strings by serialize
+        Element.__init__(self, tag, normalize_attrs(attrs) if attrs else None)
 
         for child in childs:
             self.append(child)
 
-        escape_attrs(self)
-
     def append(self, child):
-        children = list(self)
         if not isinstance(child, Element):
-            if children:
-                last_children = children[-1]
+            if self._children:
+                last_children = self._children[-1]
 
                 if last_children.tail is None:
                     last_children.tail = to_str(child)
@@ -78,16 +253,433 @@ class TagBase(Element):
             Element.append(self, child)
 
     def __repr__(self):
-        return ET.tostring(self, "utf-8", "html")
+        return str(self)
 
     def __str__(self):
         "return a string representation"
-        text = ET.tostring(self, "utf-8", "html")
+        chunks = []
+        serialize(self, chunks.append)
+        text = "".join(chunks)
         if IS_PY3:
-            return text.decode('utf8')
-        return text
+            return text
+        return text.encode('utf8')
+
+class Comment(TagBase):
+    "Defines a comment"
+
+    __slots__ = ()
+
+    def __init__(self, text=None):
+        Element.__init__(self, ET.Comment)
+        self.text = text
+
+
+class Fragment(TagBase):
+    """
+    Pre-serialized html, ``serialize`` writes ``source`` verbatim.
+
+    The source is parsed into tags the first time the children are
+    inspected. If it isn't well formed or has tags without a class here it
+    keeps being written verbatim and has no children.
+    """
+
+    __slots__ = ('source', 'verbatim', '_parsed')
+
+    def __init__(self, source):
+        self.tag = None
+        self._attrib = _NO_ATTRS
+        self.text = None
+        self.tail = None
+        self.source = source
+        self.verbatim = True
+        self._parsed = None
+
+    def _get_children(self):
+        if self._parsed is None:
+            self._parse()
+        return self._parsed
+
+    def _set_children(self, children):
+        self._parsed = children
+
+    _children = property(_get_children, _set_children)
+
+    def _parse(self):
+        try:
+            el = ET.fromstring(('<div>' + self.source + '</div>')
+                               .encode('utf8'))
+            children = [tag_from_element(child) for child in el]
+        except (ET.ParseError, ValueError):
+            self._parsed = _NO_CHILDREN
+            return
+
+        self.text = el.text
+        self._parsed = children or _NO_CHILDREN
+        self.verbatim = False
+
+    def write_source(self, write):
+        "call ``write`` with the source"
+        write(self.source)
+
+    def clear(self):
+        Element.clear(self)
+        self.source = ""
+
+    def copy(self):
+        "return a shallow copy, without parsing the source"
+        elem = Fragment(self.source)
+        elem._attrib = dict(self._attrib) if self._attrib else _NO_ATTRS
+        elem.text = self.text
+        elem.tail = self.tail
+        elem.verbatim = self.verbatim
+        if self._parsed is not None:
+            elem._parsed = list(self._parsed) or _NO_CHILDREN
+        return elem
+
+    __copy__ = copy
+
+    def __deepcopy__(self, memo):
+        elem = self.copy()
+        if elem._parsed:
+            elem._parsed = [child.__deepcopy__(memo)
+                            for child in elem._parsed]
+        return elem
+
+    def __getstate__(self):
+        return (self.source, self.verbatim, self._parsed or None,
+                self.text, self.tail)
+
+    def __setstate__(self, state):
+        (self.source, self.verbatim, self._parsed,
+         self.text, self.tail) = state
+        self.tag = None
+        self._attrib = _NO_ATTRS
+        if self._parsed is None and not self.verbatim:
+            self._parsed = _NO_CHILDREN
+
+
+class SpooledFragment(Fragment):
+    """
+    A fragment whose source was written utf-8 encoded to the binary file
+    ``spool`` at ``offset``, it's read back when serialized.
+    """
+
+    __slots__ = ('spool', 'offset', 'length')
+
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, spool, offset, length):
+        self.tag = None
+        self._attrib = _NO_ATTRS
+        self.text = None
+        self.tail = None
+        self.verbatim = True
+        self._parsed = None
+        self.spool = spool
+        self.offset = offset
+        self.length = length
+
+    def _chunks(self):
+        spool = self.spool
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        position = self.offset
+        end = self.offset + self.length
+
+        while position < end:
+            spool.seek(position)
+            data = spool.read(min(self.CHUNK_SIZE, end - position))
+            if not data:
+                break
+            position += len(data)
+            yield decoder.decode(data, position >= end)
+
+    @property
+    def source(self):
+        return "".join(self._chunks())
+
+    def write_source(self, write):
+        for chunk in self._chunks():
+            write(chunk)
+
+    def clear(self):
+        Element.clear(self)
+        self.length = 0
+
+    def copy(self):
+        "return a shallow copy sharing the spool"
+        if not self.verbatim:
+            return Fragment.copy(self)
+
+        elem = SpooledFragment(self.spool, self.offset, self.length)
+        elem.tail = self.tail
+        return elem
+
+    __copy__ = copy
+
+    def __reduce__(self):
+        # the spool can't be pickled, it becomes a fragment with the source
+        return (Fragment, (None,), (self.source, self.verbatim,
+                                    self._parsed or None, self.text,
+                                    self.tail))
+
+
+# ElementTree keeps the attribute order since python 3.8, before that it
+# sorted them, serialize does the same as the running ElementTree
+if sys.version_info >= (3, 8):
+    _attr_items = list
+else:
+    _attr_items = sorted
+
+
+def _escape_cdata(text):
+    if "&" in text:
+        text = text.replace("&", "&amp;")
+    if "<" in text:
+        text = text.replace("<", "&lt;")
+    if ">" in text:
+        text = text.replace(">", "&gt;")
+    return text
+
+def _escape_attrib(text):
+    if "&" in text:
+        text = text.replace("&", "&amp;")
+    if ">" in text:
+        text = text.replace(">", "&gt;")
+    if "\"" in text:
+        text = text.replace("\"", "&quot;")
+    return text
+
+def serialize(elem, write, minify=False):
+    """
+    Serialize ``elem`` and its tail calling ``write`` with each chunk.
+
+    The chunks joined together are the same as ``str(elem)``, but the
+    whole document is never held in memory at once. If ``minify`` the
+    whitespace in the text is collapsed and the stylesheets and scripts
+    are minified, see ``html5css3.minify``.
+    """
+    if minify:
+        from . import minify as minifier
+        _serialize_minified(elem, write, minifier, False)
+        return
+
+    tag = elem.tag
+    text = elem.text
+
+    if tag is ET.Comment:
+        # empty comments have no text
+        write("<!--%s-->" % _escape_cdata(text or ""))
+    elif tag is ET.ProcessingInstruction:
+        write("<?%s?>" % _escape_cdata(text))
+    elif tag is None:
+        if isinstance(elem, Fragment) and elem.verbatim:
+            elem.write_source(write)
+        else:
+            if text:
+                write(_escape_cdata(text))
+            for child in elem:
+                serialize(child, write)
+    else:
+        write("<" + tag)
+        for key, value in _attr_items(elem.items()):
+            write(" %s=\"%s\"" % (key, _escape_attrib(to_str(value))))
+        write(">")
+
+        ltag = tag.lower()
+        if text:
+            if ltag == "script" or ltag == "style":
+                write(text)
+            else:
+                write(_escape_cdata(text))
+
+        for child in elem:
+            serialize(child, write)
+
+        if ltag not in ET.HTML_EMPTY:
+            write("</" + tag + ">")
+
+    if elem.tail:
+        write(_escape_cdata(elem.tail))
+
+def _serialize_minified(elem, write, minifier, preformatted):
+    "serialize like ``serialize`` collapsing whitespace unless preformatted"
+    tag = elem.tag
+    text = elem.text
+
+    if tag is ET.Comment:
+        write("<!--%s-->" % _escape_cdata(text or ""))
+    elif tag is ET.ProcessingInstruction:
+        write("<?%s?>" % _escape_cdata(text))
+    elif tag is None:
+        if isinstance(elem, Fragment) and elem.verbatim:
+            # raw html is written as it was given
+            elem.write_source(write)
+        else:
+            if text:
+                if not preformatted:
+                    text = minifier.collapse_whitespace(text)
+                write(_escape_cdata(text))
+            for child in elem:
+                _serialize_minified(child, write, minifier, preformatted)
+    else:
+        write("<" + tag)
+        for key, value in _attr_items(elem.items()):
+            write(" %s=\"%s\"" % (key, _escape_attrib(to_str(value))))
+        write(">")
+
+        ltag = tag.lower()
+        inner = preformatted or minifier.is_preformatted(ltag,
+                                                         elem.get("class"))
+        if text:
+            kind = elem.get("type", "").lower()
+            if ltag == "style":
+                write(minifier.minified(text, "css")
+                      if kind in ("", "text/css") else text)
+            elif ltag == "script":
+                write(minifier.minified(text, "js")
+                      if kind in minifier.SCRIPT_TYPES else text)
+            elif inner:
+                write(_escape_cdata(text))
+            else:
+                write(_escape_cdata(minifier.collapse_whitespace(text)))
+
+        for child in elem:
+            _serialize_minified(child, write, minifier, inner)
+
+        if ltag not in ET.HTML_EMPTY:
+            write("</" + tag + ">")
+
+    if elem.tail:
+        tail = elem.tail
+        if not preformatted:
+            tail = minifier.collapse_whitespace(tail)
+        write(_escape_cdata(tail))
+
+
+class ChunkWriter(object):
+    """
+    Collect serialized text and pass it encoded to ``sink`` in chunks.
+    """
+
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, sink, encoding, errors='strict'):
+        self.sink = sink
+        self.encoder = codecs.getincrementalencoder(encoding)(errors)
+        self.buffer = []
+        self.size = 0
+
+    def write(self, text):
+        self.buffer.append(text)
+        self.size += len(text)
+
+        if self.size >= self.CHUNK_SIZE:
+            self.flush()
+
+    def flush(self, final=False):
+        data = self.encoder.encode("".join(self.buffer), final)
+        self.buffer = []
+        self.size = 0
+
+        if data:
+            self.sink(data)
+
+    def close(self):
+        self.flush(True)
+
+
+class TagIndex(object):
+    """
+    The tags of a tree by tag name and class.
+
+    The translator adds the tags as it creates them so postprocessors can
+    find what they look for without scanning the whole tree. Tags are
+    indexed by their name and classes when they are added, queries only
+    return the ones that still have them.
+    """
+
+    def __init__(self):
+        self._tags = {}
+        self._classes = {}
+        self._fragments = []
+
+    @classmethod
+    def from_tree(cls, tree):
+        "return the index of all the tags in tree"
+        index = cls()
+        index.add(tree)
+        return index
+
+    def add(self, tag):
+        """
+        Index tag and its descendants, fragments are indexed when a query
+        can find something in them.
+        """
+        if tag.__class__ is Fragment:
+            self._fragments.append(tag)
+            return
+
+        name = tag.tag
+        if name is not ET.Comment and name is not None:
+            self._tags.setdefault(name, []).append(tag)
+
+            cls = tag.get("class")
+            if cls:
+                for cls_name in cls.split():
+                    self._classes.setdefault(cls_name, []).append(tag)
+
+        # tags are usually added before their children, findall drops the
+        # repeated ones
+        for child in tag._children:
+            self.add(child)
+
+    def findall(self, tag=None, cls=None):
+        """
+        Return the tags named ``tag`` with the class ``cls`` in the order
+        they were added, at least one of them must be given.
+        """
+        # only the fragments that can have what is looked for are parsed,
+        # the others keep being written verbatim
+        self._add_fragments("<" + tag if tag is not None else cls)
+
+        if tag is not None:
+            candidates = self._tags.get(tag, ())
+        elif cls is not None:
+            candidates = self._classes.get(cls, ())
+        else:
+            raise ValueError("tag or cls must be given")
+
+        seen = set()
+        result = []
+
+        for elem in candidates:
+            if tag is not None and elem.tag != tag:
+                continue
+
+            if cls is not None and cls not in (elem.get("class") or "").split():
+                continue
+
+            if id(elem) not in seen:
+                seen.add(id(elem))
+                result.append(elem)
+
+        return result
+
+    def _add_fragments(self, text):
+        "index the queued fragments with text in their source"
+        if text is None:
+            return
+
+        pending = []
+
+        for fragment in self._fragments:
+            if text in fragment.source:
+                for child in fragment:
+                    self.add(child)
+            else:
+                pending.append(fragment)
 
-Comment = ET.Comment
+        self._fragments = pending
 
 
 # List of HTML tags for dynamically creating tag classes.
@@ -265,7 +857,9 @@ def _create_tags(ctx):
 
         cls = type(class_name, (TagBase,), {
             "__doc__": docs,
-            "__init__": __init__
+            "__init__": __init__,
+            "__slots__": (),
+            "TAG": intern(tag)
         })
 
         cls.QUOTE = quote_
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""
+Image dimensions read from the file headers.
+
+Supports PNG, JPEG, GIF, WebP and SVG without decoding the images, the
+sizes are cached by path and invalidated when the file changes.
+"""
+
+from __future__ import absolute_import
+
+import re
+import struct
+
+from .assets import AssetCache
+
+
+# bytes read to find the size of formats with a fixed header
+HEADER_SIZE = 32
+# bytes of an svg file searched for the root element
+SVG_HEADER_SIZE = 64 * 1024
+# maximum number of cached sizes
+CACHE_SIZE = 4096
+
+
+class SizeCache(AssetCache):
+    "Cache of image sizes by path, max_size is the number of images"
+
+    def _size(self, content):
+        return 1
+
+
+_cache = SizeCache(CACHE_SIZE)
+
+
+def _png_size(header, f):
+    if header[12:16] == b'IHDR':
+        return struct.unpack('>II', header[16:24])
+
+
+def _gif_size(header, f):
+    return struct.unpack('<HH', header[6:10])
+
+
+def _jpeg_size(header, f):
+    f.seek(2)
+
+    while True:
+        marker = f.read(2)
+        if len(marker) != 2 or marker[0:1] != b'\xff':
+            return None
+
+        code = ord(marker[1:2])
+        if code == 0xff:
+            # fill byte, the marker code follows
+            f.seek(-1, 1)
+            continue
+
+        if code == 0xd8 or 0xd0 <= code <= 0xd7:
+            # markers without a length
+            continue
+
+        length = f.read(2)
+        if len(length) != 2:
+            return None
+        length = struct.unpack('>H', length)[0]
+
+        # start of frame markers, except DHT, JPG and DAC
+        if 0xc0 <= code <= 0xcf and code not in (0xc4, 0xc8, 0xcc):
+            data = f.read(5)
+            if len(data) != 5:
+                return None
+            height, width = struct.unpack('>xHH', data)
+            return width, height
+
+        f.seek(length - 2, 1)
+
+
+def _webp_size(header, f):
+    chunk = header[12:16]
+
+    if chunk == b'VP8 ' and header[23:26] == b'\x9d\x01\x2a':
+        width, height = struct.unpack('<HH', header[26:30])
+        return width & 0x3fff, height & 0x3fff
+    elif chunk == b'VP8L' and header[20:21] == b'\x2f':
+        bits = struct.unpack('<I', header[21:25])[0]
+        return (bits & 0x3fff) + 1, ((bits >> 14) & 0x3fff) + 1
+    elif chunk == b'VP8X':
+        width = struct.unpack('<I', header[24:27] + b'\0')[0]
+        height = struct.unpack('<I', header[27:30] + b'\0')[0]
+        return width + 1, height + 1
+
+
+_SVG_ROOT = re.compile(br'<svg\b[^>]*>', re.S)
+_SVG_LENGTH = re.compile(br'^\s*([0-9]*\.?[0-9]+)\s*(px)?\s*$')
+
+
+def _svg_attribute(root, name):
+    match = re.search(br'\s' + name + br'\s*=\s*(["\'])(.*?)\1', root, re.S)
+    return match.group(2) if match else None
+
+
+def _svg_number(value):
+    number = float(value)
+    return int(number) if number.is_integer() else number
+
+
+def _svg_size(header, f):
+    match = _SVG_ROOT.search(header + f.read(SVG_HEADER_SIZE - len(header)))
+    if match is None:
+        return None
+
+    root = match.group(0)
+    width = _svg_attribute(root, b'width')
+    height = _svg_attribute(root, b'height')
+
+    if width is not None and height is not None:
+        width = _SVG_LENGTH.match(width)
+        height = _SVG_LENGTH.match(height)
+        if width and height:
+            return (_svg_number(width.group(1)),
+                    _svg_number(height.group(1)))
+        # relative or physical units, the size depends on where it's shown
+        return None
+
+    view_box = _svg_attribute(root, b'viewBox')
+    if view_box is not None:
+        values = view_box.replace(b',', b' ').split()
+        if len(values) == 4:
+            try:
+                return _svg_number(values[2]), _svg_number(values[3])
+            except ValueError:
+                return None
+
+
+def _read_size(path):
+    with open(path, 'rb') as f:
+        header = f.read(HEADER_SIZE)
+
+        if header.startswith(b'\x89PNG\r\n\x1a\n'):
+            reader = _png_size
+        elif header[:6] in (b'GIF87a', b'GIF89a'):
+            reader = _gif_size
+        elif header.startswith(b'\xff\xd8'):
+            reader = _jpeg_size
+        elif header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+            reader = _webp_size
+        elif (b'<svg' in header or b'<?xml' in header or
+              path.lower().endswith('.svg')):
+            reader = _svg_size
+        else:
+            return None
+
+        try:
+            return reader(header, f)
+        except (struct.error, ValueError):
+            return None
+
+
+def get_size(path):
+    """
+    Return (width, height) of the image at path in pixels or None if the
+    file can't be read or the format isn't supported.
+    """
+    try:
+        return _cache.get(path, _read_size)
+    except (IOError, OSError, UnicodeError):
+        return None
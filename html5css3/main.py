@@ -23,11 +23,30 @@ def main():
     command_dir = os.path.dirname(command)[:-3]
     sys.path.append(command_dir)
 
-    from docutils.core import publish_cmdline, default_description
+    from docutils.core import Publisher, default_description
 
     import html5css3
+    # the server and watch modes are loaded only when used
+    from html5css3 import batch, compress
     description = ('Generates html5 documents from standalone reStructuredText '
                    'sources.  ' + default_description)
 
-    publish_cmdline(writer_name='html5', writer=html5css3.Writer(),
-            description=description)
+    # compress.FileInput also reads .rst.gz sources
+    pub = Publisher(writer=html5css3.Writer(),
+                    source_class=compress.FileInput)
+    pub.set_components('standalone', 'restructuredtext', 'html5')
+    pub.process_command_line(description=description,
+            settings_spec=batch.BatchOptions())
+
+    if pub.settings.serve:
+        from html5css3 import server
+        sys.exit(server.run(pub.settings))
+
+    if pub.settings.watch:
+        from html5css3 import watch
+        sys.exit(watch.run(pub.settings))
+
+    if pub.settings.jobs is not None:
+        sys.exit(batch.run(pub.settings))
+
+    pub.publish(enable_exit_status=True)
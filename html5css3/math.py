@@ -10,20 +10,116 @@ Math handling for ``html5css3``.
 
 from __future__ import unicode_literals
 
-import codecs
+import copy
+import hashlib
+import json
 import os.path
+import threading
+from collections import OrderedDict
 
-from docutils.utils.math.unichar2tex import uni2tex_table
-from docutils.utils.math import math2html, pick_math_environment
-from docutils.utils.math.latex2mathml import parse_latex_math
+import docutils
 
+from . import assets
 from .html import *
 
 
-__all__ = ['HTMLMathHandler', 'LateXMathHandler', 'MathHandler',
+__all__ = ['HTMLMathHandler', 'LateXMathHandler', 'MathCache', 'MathHandler',
            'MathJaxMathHandler', 'MathMLMathHandler', 'SimpleMathHandler']
 
 
+def _dump_tag(tag):
+    "return the root tag of a formula and its serialized content as json"
+    chunks = []
+    for child in tag:
+        serialize(child, chunks.append)
+
+    return json.dumps({'tag': tag.tag, 'attrib': dict(tag.attrib),
+                       'text': tag.text, 'content': ''.join(chunks)})
+
+
+def _load_tag(data):
+    "return the tag dumped to data by ``_dump_tag``"
+    data = json.loads(data)
+    cls = globals()[data['tag'].title()]
+    if not issubclass(cls, TagBase):
+        raise ValueError("TagBase doesn't have a subclass for '%s'." %
+                         data['tag'])
+
+    tag = cls(Fragment(data['content']))
+    tag.attrib.update(data['attrib'])
+    tag.text = data['text']
+    return tag
+
+
+class MathCache(object):
+    """
+    Cache of converted formulas.
+
+    Keeps the most recently used ``max_entries`` tags in memory, if a
+    directory is given to ``get`` and ``put`` the tags are also stored
+    there as json so they survive between runs.
+    """
+
+    def __init__(self, max_entries=2048):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _filename(key, directory):
+        # the conversion depends on the docutils version
+        digest = hashlib.sha1(repr((docutils.__version__,) + key)
+                              .encode('utf-8')).hexdigest()
+        return os.path.join(directory, digest + '.json')
+
+    def get(self, key, directory=None):
+        "return the tag stored for key or None"
+        with self._lock:
+            tag = self._entries.pop(key, None)
+            if tag is not None:
+                self._entries[key] = tag
+                return tag
+
+        if directory:
+            try:
+                with open(self._filename(key, directory), 'rb') as f:
+                    tag = _load_tag(f.read().decode('utf-8'))
+            except (IOError, OSError, ValueError, KeyError, TypeError,
+                    AttributeError):
+                return None
+
+            self._store(key, tag)
+
+        return tag
+
+    def put(self, key, tag, directory=None):
+        "store tag for key"
+        self._store(key, tag)
+
+        if directory:
+            try:
+                assets.write_atomic(self._filename(key, directory),
+                                    _dump_tag(tag).encode('utf-8'))
+            except (IOError, OSError):
+                # the formula is converted again next time
+                pass
+
+    def _store(self, key, tag):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = tag
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+CACHE = MathCache()
+
+
 class MathHandler(object):
     """
     Abstract math handler.
@@ -31,11 +127,19 @@ class MathHandler(object):
     CLASS = None
     BLOCK_WRAPPER = '%(code)s'
     INLINE_WRAPPER = '%(code)s'
+    # cache the tags created by _create_tag, for expensive conversions
+    CACHED = False
 
-    def __init__(self):
+    def __init__(self, cache_dir=None):
         self._setup_done = False
+        self.cache_dir = cache_dir
 
     def convert(self, translator, node, block):
+        # the docutils math modules are slow to import, load them only
+        # for documents with math
+        from docutils.utils.math import pick_math_environment
+        from docutils.utils.math.unichar2tex import uni2tex_table
+
         if not self._setup_done:
             self._setup(translator)
             self._setup_done = True
@@ -48,11 +152,22 @@ class MathHandler(object):
             wrapper = self.INLINE_WRAPPER
         code = code.translate(uni2tex_table)
         code = wrapper % {'code': code, 'env': env}
-        tag = self._create_tag(code, block)
+        if self.CACHED:
+            tag = self._cached_tag(code, block)
+        else:
+            tag = self._create_tag(code, block)
         if self.CLASS:
             tag.attrib['class'] = self.CLASS
         return tag
 
+    def _cached_tag(self, code, block):
+        key = (self.__class__.__name__, block, code)
+        tag = CACHE.get(key, self.cache_dir)
+        if tag is None:
+            tag = self._create_tag(code, block)
+            CACHE.put(key, tag, self.cache_dir)
+        return copy.deepcopy(tag)
+
     def _create_tag(self, code, block):
         raise NotImplementedError('Must be implemented in subclass.')
 
@@ -112,8 +227,7 @@ class MathJaxMathHandler(SimpleMathHandler):
         super(MathJaxMathHandler, self).__init__()
         self.js_url = js_url or self.DEFAULT_URL
         if config_filename:
-            with codecs.open(config_filename, 'r', encoding='utf8') as f:
-                self.config = f.read()
+            self.config = assets.read(config_filename)
         else:
             self.config = self.DEFAULT_CONFIG
 
@@ -129,20 +243,21 @@ class MathMLMathHandler(MathHandler):
     """
     BLOCK_WRAPPER = '%(code)s'
     INLINE_WRAPPER = '%(code)s'
+    CACHED = True
 
     def _create_tag(self, code, block):
+        from docutils.utils.math.latex2mathml import parse_latex_math
+
         tree = parse_latex_math(code, inline=(not block))
-        html = ''.join(tree.xml())
-        tag = html_to_tags(html)[0]
+        # the children are written as converted, only the root is a tag
+        tag = Math(Fragment(''.join(tree.xml_body())))
+        if block:
+            tag.attrib['mode'] = 'display'
+        tag.attrib['xmlns'] = 'http://www.w3.org/1998/Math/MathML'
+        return tag
 
-        def strip_ns(tag):
-            del tag.attrib['xmlns']
-            for child in tag:
-                strip_ns(child)
 
-        for child in tag:
-            strip_ns(child)
-        return tag
+_MATH2HTML_LOCK = threading.Lock()
 
 
 class HTMLMathHandler(MathHandler):
@@ -153,19 +268,23 @@ class HTMLMathHandler(MathHandler):
     BLOCK_WRAPPER = '\\begin{%(env)s}\n%(code)s\n\\end{%(env)s}'
     INLINE_WRAPPER = '$%(code)s$'
     DEFAULT_CSS = os.path.join(os.path.dirname(__file__), 'math.css')
+    CACHED = True
 
-    def __init__(self, css_filename=None):
-        super(HTMLMathHandler, self).__init__()
+    def __init__(self, css_filename=None, cache_dir=None):
+        super(HTMLMathHandler, self).__init__(cache_dir)
         self.css_filename = css_filename or self.DEFAULT_CSS
 
     def _create_tag(self, code, block):
-        math2html.DocumentParameters.displaymode = block
-        html = math2html.math2html(code)
-        tags = html_to_tags(html)
+        from docutils.utils.math import math2html
+
+        # the display mode is global to math2html, threads take turns
+        with _MATH2HTML_LOCK:
+            math2html.DocumentParameters.displaymode = block
+            html = math2html.math2html(code)
         if block:
-            return Div(*tags)
+            return Div(Fragment(html))
         else:
-            return Span(*tags)
+            return Span(Fragment(html))
 
     def _setup(self, translator):
         translator.css(os.path.relpath(self.css_filename))
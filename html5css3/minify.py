@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""
+Conservative minification of the html, css and js written by ``--minify``.
+
+Runs of whitespace in text are collapsed to one space, except inside the
+tags in ``PREFORMATTED`` or with a class in ``PREFORMATTED_CLASSES``. Comments and the whitespace that can't change
+the meaning of the code are removed from stylesheets and scripts, nothing
+is renamed or rewritten. Comments starting with ``/*!``, usually licenses,
+are kept.
+
+Stylesheets and scripts are the same on every page, the minified text is
+cached by the hash of the original so each one is minified once per
+process.
+"""
+
+from __future__ import absolute_import
+
+import hashlib
+import re
+
+from .assets import AssetCache
+
+
+# tags where whitespace is significant
+PREFORMATTED = frozenset(('pre', 'textarea', 'code'))
+# classes of the tags where whitespace is significant, the LaTeX sources
+# for MathJax end their % comments with a newline
+PREFORMATTED_CLASSES = frozenset(('math',))
+
+# script types that are minified as javascript
+SCRIPT_TYPES = frozenset(('', 'text/javascript', 'application/javascript',
+                          'module'))
+
+# only ascii whitespace collapses, no-break spaces are kept
+_WHITESPACE = re.compile(r'[ \t\n\r\f]+')
+
+
+def is_preformatted(tag, cls):
+    "return True if whitespace is significant in the tag with class cls"
+    if tag in PREFORMATTED:
+        return True
+
+    return bool(cls) and not PREFORMATTED_CLASSES.isdisjoint(cls.split())
+
+
+def collapse_whitespace(text):
+    "return text with each run of whitespace replaced by a space"
+    return _WHITESPACE.sub(' ', text)
+
+
+_CSS_TOKEN = re.compile(r'''
+    ("(?:[^"\\\n]|\\.)*"|'(?:[^'\\\n]|\\.)*')   # string
+  | (/\*.*?\*/)                                 # comment
+  | ([ \t\n\r\f]+)                              # whitespace
+  | ([^"'/ \t\n\r\f]+|.)                        # anything else
+''', re.S | re.X)
+
+# whitespace before or after these is never needed
+_CSS_AFTER = frozenset('{};,:')
+_CSS_BEFORE = frozenset('{};,')
+
+
+def minify_css(text):
+    "return the css in text without comments and needless whitespace"
+    out = []
+    space = False
+
+    for match in _CSS_TOKEN.finditer(text):
+        string, comment, whitespace, other = match.groups()
+
+        if whitespace is not None or (comment is not None and
+                                      not comment.startswith('/*!')):
+            space = True
+            continue
+
+        token = string or comment or other
+
+        if other is not None:
+            if token[0] == '}' and out and out[-1][-1] == ';':
+                out[-1] = out[-1][:-1]
+            token = token.replace(';}', '}')
+
+        if (space and out and out[-1] and out[-1][-1] not in _CSS_AFTER and
+                token[0] not in _CSS_BEFORE):
+            out.append(' ')
+
+        out.append(token)
+        space = False
+
+    return ''.join(out)
+
+
+_JS_STRING = re.compile(r'''
+    "(?:[^"\\\n]|\\.)*"
+  | '(?:[^'\\\n]|\\.)*'
+''', re.S | re.X)
+_JS_REGEXP = re.compile(r'/(?:[^/\\\n\[]|\\.|\[(?:[^\]\\\n]|\\.)*\])+/\w*')
+_JS_BLOCK_COMMENT = re.compile(r'/\*.*?\*/', re.S)
+_JS_LINE_COMMENT = re.compile(r'//[^\n]*')
+_JS_WHITESPACE = re.compile(r'[ \t\n\r\f\v]+')
+_JS_WORD = re.compile(r'[\w$\\]+', re.U)
+
+# a regular expression and not a division can follow these
+_JS_REGEXP_AFTER = frozenset('(,=:[!&|?{};+-*%<>~^')
+_JS_REGEXP_KEYWORDS = frozenset(('return', 'typeof', 'case', 'do', 'else',
+                                 'in', 'instanceof', 'new', 'delete', 'void',
+                                 'throw', 'yield', 'await'))
+# a newline after these never ends a statement
+_JS_NEWLINE_AFTER = frozenset('{[(,;=')
+
+
+def _is_word_char(char):
+    return char.isalnum() or char in '_$\\' or ord(char) > 127
+
+
+def _template_end(text, position):
+    """
+    Return the position after the template literal starting at position,
+    the ``${}`` placeholders can have strings and templates inside, or None
+    if it doesn't end.
+    """
+    end = len(text)
+    position += 1
+    depth = 0
+
+    while position < end:
+        char = text[position]
+
+        if char == '\\':
+            position += 2
+        elif depth == 0 and char == '`':
+            return position + 1
+        elif depth == 0:
+            if text.startswith('${', position):
+                depth = 1
+                position += 1
+            position += 1
+        elif char == '`':
+            position = _template_end(text, position)
+            if position is None:
+                return None
+        elif char in '"\'':
+            match = _JS_STRING.match(text, position)
+            if match is None:
+                return None
+            position = match.end()
+        else:
+            if char == '{':
+                depth += 1
+            elif char == '}':
+                depth -= 1
+            position += 1
+
+    return None
+
+
+def _js_tokens(text):
+    """
+    Yield (kind, token) for the tokens of the javascript in text, kind is
+    'space', 'newline', 'word' or 'code'.
+    """
+    position = 0
+    end = len(text)
+    # last token that wasn't whitespace or a comment
+    last = ''
+
+    while position < end:
+        char = text[position]
+
+        if char == '`':
+            template_end = _template_end(text, position)
+            if template_end is None:
+                # unterminated, keep the rest as it is
+                yield 'code', text[position:]
+                return
+
+            last = text[position:template_end]
+            position = template_end
+            yield 'code', last
+            continue
+        elif char in '"\'':
+            match = _JS_STRING.match(text, position)
+            kind = 'code'
+        elif text.startswith('/*', position):
+            match = _JS_BLOCK_COMMENT.match(text, position)
+            if match is None:
+                # unterminated, keep the rest as it is
+                yield 'code', text[position:]
+                return
+
+            comment = match.group()
+            position = match.end()
+
+            if comment.startswith('/*!'):
+                last = comment
+                yield 'code', comment
+            else:
+                yield ('newline' if '\n' in comment else 'space'), comment
+            continue
+        elif text.startswith('//', position):
+            match = _JS_LINE_COMMENT.match(text, position)
+            position = match.end()
+            yield 'space', match.group()
+            continue
+        elif char == '/' and (not last or last[-1] in _JS_REGEXP_AFTER or
+                              last in _JS_REGEXP_KEYWORDS):
+            match = _JS_REGEXP.match(text, position)
+            kind = 'code'
+        elif _JS_WHITESPACE.match(char):
+            match = _JS_WHITESPACE.match(text, position)
+            position = match.end()
+            yield ('newline' if '\n' in match.group() or '\r' in match.group()
+                   else 'space'), match.group()
+            continue
+        else:
+            match = _JS_WORD.match(text, position)
+            kind = 'word'
+
+        if match is None:
+            # punctuation or a string or regular expression that doesn't end
+            # in this line, it's kept as a single character
+            token = char
+            kind = 'code'
+        else:
+            token = match.group()
+
+        position += len(token)
+        last = token
+        yield kind, token
+
+
+def minify_js(text):
+    """
+    Return the javascript in text without comments and needless
+    whitespace. Newlines are kept where they can end a statement.
+    """
+    out = []
+    pending = None
+
+    for kind, token in _js_tokens(text):
+        if kind == 'newline':
+            pending = 'newline'
+            continue
+        elif kind == 'space':
+            pending = pending or 'space'
+            continue
+
+        if pending is not None and out:
+            prev = out[-1][-1]
+            first = token[0]
+
+            if pending == 'newline' and prev not in _JS_NEWLINE_AFTER:
+                out.append('\n')
+            elif ((_is_word_char(prev) and _is_word_char(first)) or
+                  (prev in '+-' and first in '+-') or
+                  (prev == '/' and first == '/')):
+                out.append(' ')
+
+        out.append(token)
+        pending = None
+
+    return ''.join(out)
+
+
+MINIFIERS = {'css': minify_css, 'js': minify_js}
+
+
+class MinifiedCache(AssetCache):
+    """
+    Cache of minified stylesheets and scripts keyed by the hash of the
+    original text.
+    """
+
+    def minify(self, text, kind):
+        "return text minified as ``kind``, 'css' or 'js'"
+        key = (kind, hashlib.sha1(text.encode('utf-8')).hexdigest())
+
+        content = self._lookup(key)
+
+        if content is None:
+            content = MINIFIERS[kind](text)
+            self._store(key, (None, content))
+
+        return content
+
+
+CACHE = MinifiedCache()
+
+
+def minified(text, kind):
+    "return text minified as ``kind``, 'css' or 'js', using the cache"
+    return CACHE.minify(text, kind)
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""
+Parallel translation of the top level sections of a document.
+
+The sections are translated in forked processes that inherit the resolved
+doctree, only the translated ``Section`` tags are sent back. The
+translator merges them where it finds the sections while walking the rest
+of the document, so the output is the same as translating it in order.
+"""
+
+from __future__ import absolute_import
+
+import os
+import threading
+
+from docutils import nodes, utils
+
+from . import assets, html
+
+
+# fewer top level sections are translated in order
+MIN_SECTIONS = 2
+
+# (translator class, document) of the document a worker translates, set by
+# the pool initializer in the forked workers only
+_document = None
+
+
+def _in_main_thread():
+    main_thread = getattr(threading, 'main_thread', None)
+    if main_thread is None:
+        # python 2
+        return isinstance(threading.current_thread(), threading._MainThread)
+    return threading.current_thread() is main_thread()
+
+
+def can_start_processes():
+    "return True if worker processes can be started from here"
+    # only imported when a document is translated or highlighted in
+    # several processes
+    import multiprocessing
+
+    if multiprocessing.current_process().daemon:
+        # the workers of a pool, like the batch ones, can't have children
+        return False
+
+    # forking while other threads run, like the server ones, can copy
+    # their locks held and deadlock the children
+    return _in_main_thread()
+
+
+def _fork_context():
+    "return a multiprocessing context that forks or None if there is none"
+    if not can_start_processes():
+        return None
+
+    import multiprocessing
+
+    get_context = getattr(multiprocessing, 'get_context', None)
+    if get_context is None:
+        # python 2 always forks on posix
+        return multiprocessing if os.name == 'posix' else None
+    elif 'fork' in multiprocessing.get_all_start_methods():
+        return get_context('fork')
+    else:
+        return None
+
+
+def _init_worker(translator_class, document):
+    global _document
+    # forked, the document is inherited and not pickled
+    _document = (translator_class, document)
+
+
+def _translate(args):
+    position, serialized = args
+    translator_class, document = _document
+    visitor = translator_class(document)
+    dependencies = utils.DependencyList()
+
+    with assets.recording(dependencies):
+        visitor.walkabout(document[position])
+
+    if serialized:
+        chunks = []
+        for tag in visitor.root:
+            html.serialize(tag, chunks.append, document.settings.minify)
+        tags = [html.Fragment(''.join(chunks))]
+    else:
+        tags = list(visitor.root)
+
+    return tags, visitor.math_handler._setup_done, dependencies.list
+
+
+def translate_sections(translator_class, document, jobs=None,
+                       serialized=False):
+    """
+    Translate the top level sections of document in ``jobs`` processes, one
+    per CPU if not given. If ``serialized`` the sections are sent back as
+    html in a ``Fragment``, much faster than the tags when no postprocessor
+    looks into them.
+
+    Return a dict of ``id(section)`` to a (tags, math used, dependencies)
+    tuple or None if the document has too few sections or processes can't
+    be forked here, outside the main thread they never are.
+    """
+    positions = [i for (i, child) in enumerate(document.children)
+                 if isinstance(child, nodes.section)]
+    if len(positions) < MIN_SECTIONS:
+        return None
+
+    context = _fork_context()
+    if context is None:
+        return None
+
+    pool = context.Pool(jobs or None, _init_worker,
+                        (translator_class, document))
+
+    try:
+        results = pool.map(_translate, [(position, serialized)
+                                         for position in positions])
+    finally:
+        pool.terminate()
+        pool.join()
+
+    return dict((id(document[position]), result)
+                for (position, result) in zip(positions, results))
@@ -4,7 +4,9 @@ import sys
 
 import html5css3
 import json
-from . import html
+from collections import OrderedDict
+
+from . import assets, html, parallel
 
 IS_PY3 = sys.version[0] == '3'
 
@@ -16,12 +18,8 @@ BASE_PATH = os.path.dirname(__file__)
 
 join_path = os.path.join
 
-if IS_PY3:
-    def read_file(path):
-        return open(path).read()
-else:
-    def read_file(path):
-        return open(path).read().decode('utf-8')
+def read_file(path):
+    return assets.read(path)
 
 def as_list(val):
     """return a list with val if val is not already a list, val otherwise"""
@@ -33,30 +31,31 @@ def as_list(val):
 def abspath(path):
     return join_path(BASE_PATH, path)
 
-def js_fullpath(path, embed=True):
-    content = read_file(path) 
-
-    if embed:
-        return html.Script(content)
+def js_fullpath(path, embed=True, asset_directory=None):
+    if asset_directory is not None:
+        return html.Script(src=asset_directory.link(path))
+    elif embed:
+        return html.Script(read_file(path))
     else:
         return html.Script(src=path)
 
-def js(path, embed=True):
-    return js_fullpath(abspath(path), embed)
-
-def css(path, embed=True):
-    content = read_file(abspath(path))
+def js(path, embed=True, asset_directory=None):
+    return js_fullpath(abspath(path), embed, asset_directory)
 
-    if embed:
-        return html.Style(content, type="text/css")
+def css(path, embed=True, asset_directory=None):
+    if asset_directory is not None:
+        return html.Link(href=asset_directory.link(abspath(path)),
+                         rel="stylesheet", type="text/css")
+    elif embed:
+        return html.Style(read_file(abspath(path)), type="text/css")
     else:
         return html.Link(href=path, rel="stylesheet", type="text/css")
 
-def pretty_print_code(tree, embed=True, params=None):
+def pretty_print_code(tree, embed=True, params=None, asset_directory=None):
     head = tree[0]
     body = tree[1]
 
-    body.append(js(join_path("thirdparty", "prettify.js"), embed))
+    body.append(js(join_path("thirdparty", "prettify.js"), embed, asset_directory))
     body.append(html.Script("$(function () { prettyPrint() })"))
 
     langs_str = params.get("langs", "")
@@ -64,13 +63,13 @@ def pretty_print_code(tree, embed=True, params=None):
 
     for lang in langs:
         lang_path = join_path("thirdparty", "prettify", "lang-" + lang + ".js")
-        body.append(js(lang_path, embed))
+        body.append(js(lang_path, embed, asset_directory))
 
-    head.append(css(join_path("thirdparty", "prettify.css")))
+    head.append(css(join_path("thirdparty", "prettify.css"), embed, asset_directory))
 
-def jquery(tree, embed=True, params=None):
+def jquery(tree, embed=True, params=None, asset_directory=None):
     body = tree[1]
-    body.append(js(join_path("thirdparty", "jquery.js"), embed))
+    body.append(js(join_path("thirdparty", "jquery.js"), embed, asset_directory))
 
 def add_class(element, cls_name):
     cls = element.get("class", "")
@@ -82,7 +81,15 @@ def add_class(element, cls_name):
 
     element.set("class", cls)
 
-def deckjs(tree, embed=True, params=None):
+def findall(tree, index, tag):
+    """return the tags named tag in tree, using the index if available"""
+    if index is None:
+        return tree.findall(".//" + tag)
+    else:
+        return index.findall(tag)
+
+def deckjs(tree, embed=True, params=None, index=None,
+           asset_directory=None):
     head = tree[0]
     body = tree[1]
 
@@ -91,41 +98,41 @@ def deckjs(tree, embed=True, params=None):
 
     add_class(body, "deck-container")
 
-    for section in tree.findall(".//section"):
+    for section in findall(tree, index, "section"):
         add_class(section, "slide")
 
     # Core and extension CSS files
-    head.append(css(path("core", "deck.core.css"), embed))
-    head.append(css(path("extensions", "goto", "deck.goto.css"), embed))
-    head.append(css(path("extensions", "menu", "deck.menu.css"), embed))
-    head.append(css(path("extensions", "navigation", "deck.navigation.css"), embed))
-    head.append(css(path("extensions", "status", "deck.status.css"), embed))
+    head.append(css(path("core", "deck.core.css"), embed, asset_directory))
+    head.append(css(path("extensions", "goto", "deck.goto.css"), embed, asset_directory))
+    head.append(css(path("extensions", "menu", "deck.menu.css"), embed, asset_directory))
+    head.append(css(path("extensions", "navigation", "deck.navigation.css"), embed, asset_directory))
+    head.append(css(path("extensions", "status", "deck.status.css"), embed, asset_directory))
 
     # Theme CSS files (menu swaps these out)
-    head.append(css(path("themes", "style", "web-2.0.css"), embed))
-    head.append(css(path("themes", "transition", "horizontal-slide.css"), embed))
+    head.append(css(path("themes", "style", "web-2.0.css"), embed, asset_directory))
+    head.append(css(path("themes", "transition", "horizontal-slide.css"), embed, asset_directory))
 
-    body.append(js(path("modernizr.custom.js"), embed))
-    jquery(tree, embed)
+    body.append(js(path("modernizr.custom.js"), embed, asset_directory))
+    jquery(tree, embed, asset_directory=asset_directory)
 
     # Deck Core and extensions
-    body.append(js(path("core", "deck.core.js"), embed))
-    body.append(js(path("extensions", "menu", "deck.menu.js"), embed))
-    body.append(js(path("extensions", "goto", "deck.goto.js"), embed))
-    body.append(js(path("extensions", "status", "deck.status.js"), embed))
-    body.append(js(path("extensions", "navigation", "deck.navigation.js"), embed))
+    body.append(js(path("core", "deck.core.js"), embed, asset_directory))
+    body.append(js(path("extensions", "menu", "deck.menu.js"), embed, asset_directory))
+    body.append(js(path("extensions", "goto", "deck.goto.js"), embed, asset_directory))
+    body.append(js(path("extensions", "status", "deck.status.js"), embed, asset_directory))
+    body.append(js(path("extensions", "navigation", "deck.navigation.js"), embed, asset_directory))
 
     body.append(html.Script("$(function () { $.deck('.slide'); });"))
 
-def add_js(tree, embed=True, params=None):
+def add_js(tree, embed=True, params=None, asset_directory=None):
     params = params or {}
     paths = as_list(params.get("path", []))
 
     body = tree[1]
     for path in paths:
-        body.append(js_fullpath(path, embed))
+        body.append(js_fullpath(path, embed, asset_directory))
 
-def revealjs(tree, embed=True, params=None):
+def revealjs(tree, embed=True, params=None, asset_directory=None):
     import json
 
     head = tree[0]
@@ -154,11 +161,11 @@ def revealjs(tree, embed=True, params=None):
 
     # <link rel="stylesheet" href="css/reveal.css">
     # <link rel="stylesheet" href="css/theme/default.css" id="theme">
-    head.append(css(path("css", "reveal.css"), embed))
-    head.append(css(theme_path, embed))
+    head.append(css(path("css", "reveal.css"), embed, asset_directory))
+    head.append(css(theme_path, embed, asset_directory))
 
     if printpdf:
-        head.append(css(path("css", "print", "pdf.css"), embed))
+        head.append(css(path("css", "print", "pdf.css"), embed, asset_directory))
     else:
         # Embed print-pdf URL semantics
         css_print = read_file(abspath(path("css", "print", "pdf.css")))
@@ -178,17 +185,17 @@ def revealjs(tree, embed=True, params=None):
 
     # <script src="lib/js/head.min.js"></script>
     # <script src="js/reveal.js"></script>
-    body.append(js(path("lib", "js", "head.min.js"), embed))
-    body.append(js(path("js", "reveal.js"), embed))
+    body.append(js(path("lib", "js", "head.min.js"), embed, asset_directory))
+    body.append(js(path("js", "reveal.js"), embed, asset_directory))
 
-    head.append(css("rst2html5-reveal.css", embed))
+    head.append(css("rst2html5-reveal.css", embed, asset_directory))
 
     params['history'] = True
     param_s = json.dumps(params)
     body.append(
         html.Script("$(function () { Reveal.initialize(%s); });" % param_s))
 
-def impressjs(tree, embed=True, params=None):
+def impressjs(tree, embed=True, params=None, asset_directory=None):
     head = tree[0]
     body = tree[1]
 
@@ -214,53 +221,182 @@ def impressjs(tree, embed=True, params=None):
     body.append(slides)
 
     # <script src="js/impress.js"></script>
-    body.append(js(path("js", "impress.js"), embed))
+    body.append(js(path("js", "impress.js"), embed, asset_directory))
 
     body.append(html.Script("impress().init();"))
 
-def bootstrap_css(tree, embed=True, params=None):
+def bootstrap_css(tree, embed=True, params=None, asset_directory=None):
     head = tree[0]
 
-    head.append(css(join_path("thirdparty", "bootstrap.css"), embed))
-
-def embed_images(tree, embed=True, params=None):
+    head.append(css(join_path("thirdparty", "bootstrap.css"), embed, asset_directory))
+
+IMAGE_TYPES = {
+    ".png": "image/png",
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".gif": "image/gif",
+    ".svg": "image/svg+xml",
+    ".webp": "image/webp",
+}
+# encoded data URIs of the images, invalidated when the image changes
+DATA_URIS = assets.AssetCache()
+# threads reading and encoding the images of a document
+IMAGE_THREADS = 4
+# bytes encoded at once, a multiple of 3 so the chunks can be joined
+ENCODE_CHUNK_SIZE = 3 * 64 * 1024
+
+def encode_data_uri(path):
     import base64
-    for image in tree.findall(".//img"):
-        path = image.attrib['src']
-        lowercase_path = path.lower()
-
-        if lowercase_path.endswith(".png"):
-            content_type = "image/png"
-        elif lowercase_path.endswith(".jpg"):
-            content_type = "image/jpg"
-        elif lowercase_path.endswith(".gif"):
-            content_type = "image/gif"
-        else:
-            continue
-
-        encoded = base64.b64encode(open(path, 'rb').read()).decode('utf-8')
-        content = "data:%s;base64,%s" % (content_type, encoded)
-        image.set('src', content)
-
-def pygmentize(tree, embed=True, params=None):
-    from pygments import highlight
-    from pygments.lexers import get_lexer_by_name
-    from pygments.formatters import HtmlFormatter
 
-    pygments_formatter = HtmlFormatter()
-    body = tree[1]
+    content_type = IMAGE_TYPES[os.path.splitext(path.lower())[1]]
+    chunks = ["data:%s;base64," % content_type]
+
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(ENCODE_CHUNK_SIZE), b''):
+            chunks.append(base64.b64encode(chunk).decode('ascii'))
+
+    return "".join(chunks)
+
+def data_uri(path):
+    """return the image at path as a data URI, cached until it changes"""
+    return DATA_URIS.get(path, encode_data_uri)
+
+def embed_images(tree, embed=True, params=None, index=None):
+    params = params or {}
+    threads = params.get("threads", IMAGE_THREADS)
+
+    # every image is encoded once even if it appears several times
+    images = OrderedDict()
+    # svg images are placed in an object tag
+    tags = [(image, 'src') for image in findall(tree, index, "img")]
+    tags.extend((image, 'data') for image in findall(tree, index, "object"))
+
+    for image, attr in tags:
+        path = image.attrib.get(attr)
+
+        if path and os.path.splitext(path.lower())[1] in IMAGE_TYPES:
+            images.setdefault(path, []).append((image, attr))
+
+    paths = list(images)
+    for path in paths:
+        assets.record(path)
+
+    if threads > 1 and len(paths) > 1:
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(min(threads, len(paths)))
+        try:
+            uris = pool.map(data_uri, paths)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        uris = [data_uri(path) for path in paths]
+
+    for path, uri in zip(paths, uris):
+        for image, attr in images[path]:
+            image.set(attr, uri)
+
+_lexers = {}
+_formatter = None
+# maximum number of characters of highlighted code kept in memory
+HIGHLIGHT_CACHE_SIZE = 16 * 1024 * 1024
+
+def get_lexer(lang):
+    """return a cached lexer for lang, the text lexer if lang is unknown"""
+    lexer = _lexers.get(lang)
+
+    if lexer is None:
+        from pygments.lexers import get_lexer_by_name
 
-    def highlight_code(lang, code):
         try:
             lexer = get_lexer_by_name(lang)
         except ValueError:
             # no lexer found - use the text one instead of an exception
             lexer = get_lexer_by_name('text')
 
-        parsed = highlight(code, lexer, pygments_formatter)
-        return parsed
+        _lexers[lang] = lexer
+
+    return lexer
+
+def get_formatter():
+    """return the formatter shared by all the highlighted blocks"""
+    global _formatter
+
+    if _formatter is None:
+        from pygments.formatters import HtmlFormatter
+        _formatter = HtmlFormatter()
 
-    for block in body.findall(".//pre"):
+    return _formatter
+
+def highlight_code(lang, code):
+    from pygments import highlight
+    return highlight(code, get_lexer(lang), get_formatter())
+
+def _highlight_job(lang_code):
+    return highlight_code(*lang_code)
+
+def highlight_key(lang, code):
+    """key of the highlighted code in the caches, includes everything that
+    changes the output"""
+    import hashlib
+    import pygments
+
+    options = sorted((key, repr(value))
+                     for (key, value) in get_formatter().options.items())
+    code_hash = hashlib.sha1(code.encode('utf-8')).hexdigest()
+    key = repr((pygments.__version__, lang, code_hash, options))
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+class HighlightCache(assets.AssetCache):
+    """
+    Cache of highlighted code keyed by ``highlight_key``, optionally kept
+    in a directory between runs.
+    """
+
+    def lookup(self, key, cache_dir=None):
+        "return the highlighted code for key, None if it's not cached"
+        content = self._lookup(key)
+
+        if content is None and cache_dir:
+            import io
+            try:
+                with io.open(join_path(cache_dir, key + '.html'),
+                             encoding='utf-8') as f:
+                    content = f.read()
+            except (IOError, OSError):
+                return None
+
+            self._store(key, (None, content))
+
+        return content
+
+    def store(self, key, content, cache_dir=None):
+        "cache the highlighted code for key"
+        self._store(key, (None, content))
+
+        if cache_dir:
+            try:
+                assets.write_atomic(join_path(cache_dir, key + '.html'),
+                                    content.encode('utf-8'))
+            except (IOError, OSError):
+                # highlighted again next time
+                pass
+
+_highlighted = HighlightCache(HIGHLIGHT_CACHE_SIZE)
+
+def pygmentize(tree, embed=True, params=None, index=None):
+    params = params or {}
+    cache_dir = params.get("cache")
+    jobs = params.get("jobs")
+    body = tree[1]
+
+    pending = []
+    if index is None:
+        blocks = body.findall(".//pre")
+    else:
+        blocks = index.findall("pre", "code")
+
+    for block in blocks:
         cls = block.attrib.get('class', '')
         classes = cls.split()
         if 'code' in classes:
@@ -268,10 +404,34 @@ def pygmentize(tree, embed=True, params=None):
 
             if len(lang_classes) > 0:
                 lang = lang_classes[0][5:]
+                code = block.text or ''
+                key = highlight_key(lang, code)
+                new_content = _highlighted.lookup(key, cache_dir)
+
+                if new_content is None:
+                    pending.append((block, key, lang, code))
+                else:
+                    block.tag = 'div'
+                    block.text = new_content
+
+    jobs_args = [(lang, code) for (_, _, lang, code) in pending]
+
+    if (jobs is not None and len(pending) > 1 and
+            parallel.can_start_processes()):
+        import multiprocessing
+        pool = multiprocessing.Pool(jobs or None)
+        try:
+            results = pool.map(_highlight_job, jobs_args)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_highlight_job(args) for args in jobs_args]
 
-                new_content = highlight_code(lang, block.text)
-                block.tag = 'div'
-                block.text = new_content
+    for (block, key, _, _), new_content in zip(pending, results):
+        _highlighted.store(key, new_content, cache_dir)
+        block.tag = 'div'
+        block.text = new_content
 
 def mathjax(tree, embed=True, params=None):
     body = tree[1]
@@ -294,8 +454,7 @@ def mathjax(tree, embed=True, params=None):
       });
         """
     else:
-        with open(config_path) as f_in:
-            content = f_in.read()
+        content = read_file(config_path)
 
     body.append(html.Script(content, type="text/x-mathjax-config"))
     body.append(html.Script(src=url))
@@ -308,39 +467,49 @@ PROCESSORS = [
     }),
     ("jquery", {
         "name": "add jquery",
-        "processor": jquery
+        "processor": jquery,
+        "links_assets": True
     }),
     ("pretty_print_code", {
         "name": "pretty print code",
-        "processor": pretty_print_code
+        "processor": pretty_print_code,
+        "links_assets": True
     }),
     ("pygments", {
         "name": "pygments",
-        "processor": pygmentize
+        "processor": pygmentize,
+        "indexed": True
     }),
     ("deck_js", {
         "name": "deck.js",
-        "processor": deckjs
+        "processor": deckjs,
+        "indexed": True,
+        "links_assets": True
     }),
     ("reveal_js", {
         "name": "reveal.js",
-        "processor": revealjs
+        "processor": revealjs,
+        "links_assets": True
     }),
     ("impress_js", {
         "name": "impress.js",
-        "processor": impressjs
+        "processor": impressjs,
+        "links_assets": True
     }),
     ("bootstrap_css", {
         "name": "bootstrap css",
-        "processor": bootstrap_css
+        "processor": bootstrap_css,
+        "links_assets": True
     }),
     ("embed_images", {
         "name": "embed images",
-        "processor": embed_images
+        "processor": embed_images,
+        "indexed": True
     }),
     ("add_js", {
         "name": "add js files",
-        "processor": add_js
+        "processor": add_js,
+        "links_assets": True
     })
 ]
 
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""
+Render many documents with the same settings.
+
+``docutils.core.publish_string`` builds an option parser from the
+settings of every component, and creates a reader, a parser and a writer
+for each document. A ``Renderer`` resolves the settings once and reuses
+its reader, parser and writer, only the document and its copy of the
+settings are created for each source::
+
+    renderer = Renderer(math_output='mathml')
+    html = renderer.render(source)
+
+    for html in renderer.render_many(sources):
+        ...
+"""
+
+from __future__ import absolute_import
+
+import copy
+
+from docutils import frontend, io
+from docutils.parsers.rst import Parser
+from docutils.readers.standalone import Reader
+
+from . import Writer
+
+
+class Renderer(object):
+    """
+    Render reStructuredText sources to html with the ``html5css3`` writer.
+
+    ``settings`` are docutils settings to start from, like the ones
+    returned by ``batch.get_settings``, by default the defaults and the
+    configuration files are used. Keyword arguments override settings.
+
+    A renderer isn't thread safe, use one per thread.
+    """
+
+    def __init__(self, settings=None, **overrides):
+        self.parser = Parser()
+        self.reader = Reader(parser=self.parser)
+        self.writer = Writer()
+
+        if settings is None:
+            option_parser = frontend.OptionParser(
+                components=(self.parser, self.reader, self.writer),
+                defaults=overrides, read_config_files=True)
+            settings = option_parser.get_default_values()
+        else:
+            settings = copy.copy(settings)
+            for key, value in overrides.items():
+                setattr(settings, key, value)
+
+        self.settings = settings
+
+    def render(self, source, source_path=None, destination_path=None,
+               **overrides):
+        """
+        Return the html of ``source``, a text or bytes decoded with the
+        ``input_encoding`` setting. Keyword arguments override settings for
+        this document only, like ``emit_body=True`` for only the body.
+        """
+        settings = copy.copy(self.settings)
+        for key, value in overrides.items():
+            setattr(settings, key, value)
+
+        settings._source = source_path
+        settings._destination = destination_path
+
+        source = io.StringInput(source=source, source_path=source_path,
+                                encoding=settings.input_encoding)
+        destination = io.StringOutput(destination_path=destination_path,
+                                      encoding='unicode')
+
+        document = self.reader.read(source, self.parser, settings)
+        document.transformer.populate_from_components(
+            (source, self.reader, self.parser, self.writer, destination))
+        document.transformer.apply_transforms()
+
+        return self.writer.write(document, destination)
+
+    def render_many(self, sources):
+        """
+        Yield the html of each source, an item is a source or a tuple with
+        the source and its path.
+        """
+        for item in sources:
+            if isinstance(item, tuple):
+                yield self.render(*item)
+            else:
+                yield self.render(item)
@@ -0,0 +1,383 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""
+Render service for ``html5css3``.
+
+A long running process that renders reStructuredText sent over HTTP, on a
+localhost port or on a Unix socket, so the callers don't pay the start up
+cost on every document. Requests are rendered by a bounded pool of threads
+that keep their renderers and the asset, math and highlight caches warm.
+
+Endpoints:
+
+POST /render
+    the body is the source, the response is the HTML. Writer settings are
+    passed in the query string (``?math_output=html&part=body``) or, if the
+    request is ``application/json``, as ``{"source": ..., "settings": {...},
+    "part": "body"}``. ``part=body`` returns only the content of the body.
+    Only the settings in ``ALLOWED_SETTINGS``, that shape the output without
+    reading or writing files, can be passed. The documents can't include
+    files or raw content unless the server runs with ``--serve-trusted``.
+
+GET /health
+    ``{"status": "ok", ...}`` while the server is up.
+
+GET /stats
+    request counts and render latencies in seconds as JSON.
+"""
+
+from __future__ import absolute_import
+
+import collections
+import copy
+import json
+import multiprocessing
+import os
+import socket
+import sys
+import threading
+import time
+import timeit
+
+from docutils.utils import SystemMessage
+
+from . import Renderer, parse_param_value
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import UnixStreamServer
+    from urlparse import parse_qsl, urlparse
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import UnixStreamServer
+    from urllib.parse import parse_qsl, urlparse
+
+from multiprocessing.pool import ThreadPool
+
+
+# maximum size of a request body
+MAX_REQUEST_SIZE = 16 * 1024 * 1024
+# number of latencies kept for the statistics
+LATENCY_SAMPLES = 1000
+# host of the TCP address when only the port is given
+DEFAULT_HOST = '127.0.0.1'
+
+# settings a request can override, none of them reads or writes files
+ALLOWED_SETTINGS = frozenset((
+    'initial_header_level', 'field_name_limit', 'option_limit',
+    'footnote_references', 'attribution', 'compact_lists',
+    'compact_field_lists', 'table_style', 'math_output', 'mathjax_url',
+    'xml_declaration', 'cloak_email_addresses', 'favicon', 'minify',
+    'mathjax', 'jquery', 'pretty_print_code', 'pygments', 'deck_js',
+    'reveal_js', 'impress_js', 'bootstrap_css'))
+
+
+class Stats(object):
+    """
+    Request counters and the latencies of the last renders.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.requests = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.latencies = collections.deque(maxlen=LATENCY_SAMPLES)
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            self.requests += 1
+            self.in_flight += 1
+
+    def finish(self, latency, error=False):
+        with self._lock:
+            self.in_flight -= 1
+            self.latencies.append(latency)
+            if error:
+                self.errors += 1
+
+    def as_dict(self):
+        with self._lock:
+            latencies = sorted(self.latencies)
+            data = {
+                'uptime': time.time() - self.started,
+                'requests': self.requests,
+                'errors': self.errors,
+                'in_flight': self.in_flight,
+            }
+
+        def percentile(p):
+            return latencies[min(len(latencies) - 1,
+                                 int(len(latencies) * p))]
+
+        if latencies:
+            data['latency'] = {
+                'mean': sum(latencies) / len(latencies),
+                'p50': percentile(0.5),
+                'p90': percentile(0.9),
+                'p99': percentile(0.99),
+                'max': latencies[-1],
+            }
+        else:
+            data['latency'] = None
+
+        return data
+
+
+class RenderError(Exception):
+    "the request can't be rendered, the message is returned to the client"
+
+
+class RenderService(object):
+    """
+    Render sources with the server settings and the per request overrides.
+    """
+
+    def __init__(self, settings):
+        self.settings = copy.copy(settings)
+        # report errors to the client instead of exiting the server
+        self.settings.traceback = True
+        self.settings._destination = None
+        # the pool threads can't fork
+        self.settings.translate_jobs = None
+
+        if not getattr(settings, 'serve_trusted', False):
+            self.settings.file_insertion_enabled = False
+            self.settings.raw_enabled = False
+
+        self._local = threading.local()
+        self.allowed_settings = ALLOWED_SETTINGS
+
+    def renderer(self):
+        "return the renderer of this thread"
+        renderer = getattr(self._local, 'renderer', None)
+        if renderer is None:
+            renderer = self._local.renderer = Renderer(self.settings)
+        return renderer
+
+    def render(self, source, overrides=None, part=None):
+        "return the rendered source as utf-8 encoded bytes"
+        overrides = dict(overrides or {})
+
+        for key in overrides:
+            if key not in self.allowed_settings:
+                raise RenderError('setting not allowed: %s' % key)
+
+        math_output = overrides.get('math_output')
+        if math_output is not None and len(str(math_output).split()) > 1:
+            # the option of the html output is a css file to embed
+            raise RenderError('math_output options are not allowed')
+
+        overrides['emit_body'] = part == 'body'
+        overrides['output_encoding'] = 'utf-8'
+
+        try:
+            return self.renderer().render(source, **overrides).encode(
+                'utf-8')
+        except SystemMessage as error:
+            raise RenderError(str(error))
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """
+    Handle the requests to the render service.
+    """
+    server_version = 'rst2html5'
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+
+        if path == '/health':
+            self.send_json({'status': 'ok',
+                            'uptime': time.time() - self.server.stats.started})
+        elif path == '/stats':
+            data = self.server.stats.as_dict()
+            data['workers'] = self.server.workers
+            self.send_json(data)
+        else:
+            self.send_text(404, 'not found')
+
+    def do_POST(self):
+        url = urlparse(self.path)
+
+        if url.path != '/render':
+            self.send_text(404, 'not found')
+            return
+
+        length = int(self.headers.get('Content-Length') or 0)
+        if length > MAX_REQUEST_SIZE:
+            self.send_text(413, 'request too large')
+            return
+
+        body = self.rfile.read(length)
+        stats = self.server.stats
+        stats.start()
+        start = timeit.default_timer()
+        error = True
+
+        try:
+            source, overrides, part = self.read_render_request(url, body)
+            output = self.server.service.render(source, overrides, part)
+            error = False
+        except (RenderError, ValueError) as exc:
+            self.send_text(400, str(exc))
+        except Exception as exc:
+            self.send_text(500, '%s: %s' % (exc.__class__.__name__, exc))
+        else:
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('Content-Length', str(len(output)))
+            self.end_headers()
+            self.wfile.write(output)
+        finally:
+            stats.finish(timeit.default_timer() - start, error)
+
+    def read_render_request(self, url, body):
+        "return the source, the settings overrides and the part to return"
+        content_type = self.headers.get('Content-Type') or ''
+
+        if content_type.startswith('application/json'):
+            data = json.loads(body.decode('utf-8'))
+            if not isinstance(data, dict):
+                raise RenderError('the body must be a json object')
+
+            source = data.get('source')
+            settings = data.get('settings') or {}
+            part = data.get('part')
+            if source is None:
+                raise RenderError('missing source')
+            elif not isinstance(source, type(u'')):
+                raise RenderError('source must be a string')
+            elif not isinstance(settings, dict):
+                raise RenderError('settings must be an object')
+            elif part is not None and not isinstance(part, type(u'')):
+                raise RenderError('part must be a string')
+
+            return source, settings, part
+
+        overrides = dict((key, parse_param_value(value))
+                         for (key, value) in parse_qsl(url.query))
+        part = overrides.pop('part', None)
+        return body.decode('utf-8'), overrides, part
+
+    def send_text(self, status, text):
+        data = text.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_json(self, value):
+        data = json.dumps(value).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def address_string(self):
+        # unix sockets have no client address
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class PoolMixIn(object):
+    """
+    Handle each request in a bounded pool of threads.
+    """
+    workers = None
+
+    def process_request(self, request, client_address):
+        self.pool.apply_async(self.process_request_thread,
+                              (request, client_address))
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        self.socket.close()
+        self.pool.close()
+        self.pool.join()
+
+
+class RenderServer(PoolMixIn, HTTPServer):
+    "render service on a TCP port"
+
+
+class UnixRenderServer(PoolMixIn, UnixStreamServer):
+    "render service on a Unix socket"
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+        UnixStreamServer.server_bind(self)
+        self.server_name = self.server_address
+        self.server_port = 0
+
+    def server_close(self):
+        PoolMixIn.server_close(self)
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+
+
+def make_server(address, settings, workers=None, quiet=False):
+    """
+    Return a render server listening on ``address``.
+
+    ``address`` is ``unix:<path>`` for a Unix socket, ``<host>:<port>`` or
+    ``<port>`` to listen on ``DEFAULT_HOST``, only reachable from this
+    machine. ``settings`` are the docutils settings
+    requests start from, ``workers`` the number of requests rendered
+    concurrently, one per CPU by default.
+    """
+    if address.startswith('unix:'):
+        server_class = UnixRenderServer
+        server_address = address[5:]
+    else:
+        server_class = RenderServer
+        host, _, port = address.rpartition(':')
+        server_address = (host or DEFAULT_HOST, int(port))
+
+    server = server_class(server_address, RequestHandler)
+    server.workers = workers or multiprocessing.cpu_count()
+    server.pool = ThreadPool(server.workers)
+    server.service = RenderService(settings)
+    server.stats = Stats()
+    server.quiet = quiet
+    return server
+
+
+def run(settings, stream=None):
+    """
+    Serve from parsed command line settings, return the exit status.
+    """
+    stream = stream or sys.stderr
+
+    try:
+        server = make_server(settings.serve, settings, settings.serve_workers)
+    except (ValueError, socket.error) as error:
+        stream.write('--serve %s: %s\n' % (settings.serve, error))
+        return 2
+
+    stream.write('serving on %s with %d workers, press Ctrl+C to stop\n' % (
+        settings.serve, server.workers))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+    return 0
@@ -17,15 +17,28 @@ run ``tox`` in the project's root directory (this requires tox_).
 
 from __future__ import unicode_literals
 
+import base64
 import contextlib
+import copy
+import gzip
+import io
+import json
 import os.path
+import pickle
 import re
+import shutil
+import struct
+import subprocess
+import sys
 import tempfile
 import textwrap
+import threading
 
-from docutils.core import publish_string
+from docutils.core import publish_file, publish_string
 
-from . import Writer
+from . import (Writer, assets, batch, benchmark, compress, html, imagesize,
+               math, minify, parallel, postprocessors, server, watch)
+from . import HTMLTranslator, Renderer
 from .math import HTMLMathHandler, MathJaxMathHandler
 
 
@@ -144,6 +157,31 @@ def temp_file(content):
         yield f.name
 
 
+@contextlib.contextmanager
+def temp_dir():
+    """
+    Context manager that supplies a temporary directory.
+    """
+    path = tempfile.mkdtemp()
+    try:
+        yield path
+    finally:
+        shutil.rmtree(path)
+
+
+def write_file(path, content):
+    """
+    Write ``content`` to ``path``, creating missing directories.
+    """
+    dirname = os.path.dirname(path)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    if not isinstance(content, bytes):
+        content = content.encode('utf8')
+    with open(path, 'wb') as f:
+        f.write(content)
+
+
 #
 # Tests
 #
@@ -167,6 +205,29 @@ def test_multiple_and_nested_tags_in_raw():
     """)
 
 
+def test_raw_other_formats():
+    """
+    Raw content for other formats is left out.
+    """
+    RST(r"""
+        .. role:: raw-latex(raw)
+           :format: latex
+
+        .. role:: raw-html(raw)
+           :format: html
+
+        .. raw:: latex
+
+            \newpage <b>
+
+        text :raw-latex:`<i>` :raw-html:`<em>x</em>`
+
+        .. raw:: latex html
+
+            <hr>
+    """).assert_body('<p>text  <em class="raw-html">x</em></p><hr>')
+
+
 def test_non_ascii_chars_in_attributes():
     """
     Non-ASCII characters in HTML attributes.
@@ -222,6 +283,103 @@ def test_math_html_block():
     .assert_contains(_math_css_link(), 1))
 
 
+def test_math_html_threads():
+    """
+    Inline and block HTML math converted at the same time keep their mode.
+    """
+    handler = HTMLMathHandler()
+    code = '\\sum_{i=1}^n x_i'
+    expected = [str(handler._create_tag(code, block))
+                for block in (False, True)]
+    results = []
+
+    def convert(block):
+        for _ in range(50):
+            results.append(
+                str(handler._create_tag(code, block)) == expected[block])
+
+    threads = [threading.Thread(target=convert, args=(i % 2 == 1,))
+               for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert expected[0] != expected[1]
+    assert len(results) == 200 and all(results)
+
+
+def test_math_cache():
+    """
+    Repeated formulas are converted once, the disk cache survives restarts.
+    """
+    calls = []
+
+    class CountingHandler(HTMLMathHandler):
+        def _create_tag(self, code, block):
+            calls.append(code)
+            return super(CountingHandler, self)._create_tag(code, block)
+
+    with temp_dir() as cache_dir:
+        math.CACHE.clear()
+        handler = CountingHandler(cache_dir=cache_dir)
+        first = handler._cached_tag('x^2', False)
+        second = handler._cached_tag('x^2', False)
+        assert len(calls) == 1
+        assert first is not second
+        assert str(first) == str(second)
+
+        # block math is cached separately
+        handler._cached_tag('x^2', True)
+        assert len(calls) == 2
+
+        # stored as json, nothing in the directory is unpickled
+        names = sorted(os.listdir(cache_dir))
+        assert [os.path.splitext(name)[1] for name in names] == ['.json'] * 2
+        for name in names:
+            with open(os.path.join(cache_dir, name), 'rb') as f:
+                assert json.loads(f.read().decode('utf-8'))['content']
+
+        math.CACHE.clear()
+        assert str(CountingHandler(cache_dir=cache_dir)
+                   ._cached_tag('x^2', False)) == str(first)
+        assert len(calls) == 2
+
+        # broken files are converted again
+        for name in names:
+            write_file(os.path.join(cache_dir, name), b'\x80')
+        math.CACHE.clear()
+        CountingHandler(cache_dir=cache_dir)._cached_tag('x^2', False)
+        assert len(calls) == 3
+
+        # threads storing the same new formula don't collide
+        errors = []
+
+        def convert():
+            try:
+                HTMLMathHandler(cache_dir=os.path.join(cache_dir, 'new')
+                                )._cached_tag('y^2', False)
+            except Exception as error:
+                errors.append(error)
+
+        math.CACHE.clear()
+        threads = [threading.Thread(target=convert) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert errors == []
+        assert len(os.listdir(os.path.join(cache_dir, 'new'))) == 1
+
+        # a directory that can't be written doesn't fail the conversion
+        blocked = os.path.join(cache_dir, 'blocked')
+        write_file(blocked, 'not a directory')
+        assert str(HTMLMathHandler(cache_dir=blocked)
+                   ._cached_tag('z^2', False))
+
+    math.CACHE.clear()
+
+
 def test_math_html_config_math_opts():
     """
     HTML math configuration via "--math-opts".
@@ -385,3 +543,902 @@ def test_math_mathjax_config_mathjax_config():
              mathjax_config=filename)
          .assert_contains('my_config'))
 
+
+
+def test_pygments_cache():
+    """
+    Highlighted code is reused from the cache and gives the same output.
+    """
+    rst = STREAM_RST + '\n.. code-block:: python\n\n    print("<html>")\n'
+    expected = rst2html(rst, pygments=True)
+    assert expected.count('<div class="code lang-python">') == 2
+
+    with temp_dir() as cache_dir:
+        opts = 'cache="%s"' % cache_dir
+        postprocessors._highlighted.clear()
+        assert rst2html(rst, pygments=True, pygments_opts=opts) == expected
+        assert len(os.listdir(cache_dir)) == 1
+
+        postprocessors._highlighted.clear()
+        calls = []
+        highlight = postprocessors.highlight_code
+        postprocessors.highlight_code = lambda *args: calls.append(args)
+        try:
+            html = rst2html(rst, pygments=True, pygments_opts=opts)
+        finally:
+            postprocessors.highlight_code = highlight
+        assert html == expected
+        assert calls == []
+
+    with temp_dir() as path:
+        # a directory that can't be written doesn't fail the render
+        blocked = os.path.join(path, 'blocked')
+        write_file(blocked, 'not a directory')
+        postprocessors._highlighted.clear()
+        assert rst2html(rst, pygments=True,
+                        pygments_opts='cache="%s"' % blocked) == expected
+
+    cache = postprocessors.HighlightCache(max_size=8)
+    cache.store('a', '<b>a</b>')
+    cache.store('b', '<b>b</b>')
+    assert cache.lookup('a') is None and cache.lookup('b') == '<b>b</b>'
+
+    assert postprocessors.get_lexer('python') is \
+        postprocessors.get_lexer('python')
+    assert postprocessors.get_lexer('no-such-lang').name == 'Text only'
+
+
+def test_benchmark():
+    """
+    The benchmark reports every phase and postprocessor.
+    """
+    report = benchmark.run(
+        [('small', benchmark.synthetic_document(2), None, {})], repeat=1)
+    result = report['documents'][0]
+    assert set(result['phases']) == set(
+        ['parse', 'translate', 'stylesheets', 'serialize'])
+    assert set(result['postprocessors']) == set(
+        key for (key, _) in Writer.post_processors)
+    assert result['output_bytes'] > result['source_bytes'] > 0
+    assert report['total']['seconds'] == result['seconds'] > 0
+    json.dumps(report)
+
+
+def test_startup_imports():
+    """
+    Importing the entry point doesn't load the math backends, the image
+    probing, multiprocessing or the server and watch modes.
+    """
+    lazy = ['docutils.utils.math.math2html',
+            'docutils.utils.math.latex2mathml', 'html5css3.imagesize',
+            'html5css3.server', 'html5css3.watch', 'multiprocessing']
+    script = ('import sys, html5css3.main; '
+              'print(" ".join(name for name in %r if name in sys.modules))'
+              % (lazy,))
+    env = dict(os.environ, PYTHONPATH=benchmark.BASE_PATH)
+    output = subprocess.check_output([sys.executable, '-c', script], env=env)
+    assert output.decode('utf-8').split() == []
+
+    modules = benchmark.parse_importtime(
+        'import time: self [us] | cumulative | imported package\n'
+        'import time:       120 |        120 |   docutils.nodes\n'
+        'import time:      1500 |       1620 | html5css3\n')
+    assert modules == {'docutils.nodes': (0.00012, 0.00012),
+                       'html5css3': (0.0015, 0.00162)}
+
+
+def test_timing_report():
+    """
+    The timings of every phase, postprocessor and node type are reported.
+    """
+    reports = []
+    writer = Writer(timing_callback=reports.append)
+    expected = rst2html(STREAM_RST)
+    html = publish_string(STREAM_RST, writer=writer,
+                          settings_overrides={'jquery': True})
+    assert html.decode('utf8') == rst2html(STREAM_RST, jquery=True)
+    assert 'jquery' not in expected
+
+    report = reports[0].as_dict()
+    assert list(report['phases']) == ['translate', 'stylesheets',
+                                      'serialize']
+    assert list(report['postprocessors']) == ['jquery']
+    assert report['nodes']['paragraph']['visits'] == 3
+    assert report['nodes']['section']['visits'] == 1
+    assert report['total']['wall'] > 0
+
+    with temp_dir() as path:
+        report_path = os.path.join(path, 'timings.json')
+        for _ in range(2):
+            assert rst2html(STREAM_RST, timing_report=report_path) == expected
+        with open(report_path) as f:
+            lines = [json.loads(line) for line in f]
+        assert len(lines) == 2
+        assert lines[0]['nodes']['paragraph']['visits'] == 3
+
+
+def test_asset_dir():
+    """
+    Assets are copied once under content hashed names and linked.
+    """
+    with temp_dir() as path:
+        asset_dir = os.path.join(path, 'assets')
+        html = rst2html('text', asset_dir=asset_dir, jquery=True,
+                        _destination=os.path.join(path, 'a.html'))
+        names = sorted(os.listdir(asset_dir))
+        assert len(names) == 2
+        assert re.match(r'jquery\.[0-9a-f]{16}\.js$', names[0])
+        assert re.match(r'rst2html5\.[0-9a-f]{16}\.css$', names[1])
+        assert '<script src="assets/%s"></script>' % names[0] in html
+        assert '<link href="assets/%s" rel="stylesheet"' % names[1] in html
+        assert '<style' not in html
+
+        with open(os.path.join(asset_dir, names[0]), 'rb') as f:
+            with open(postprocessors.abspath('thirdparty/jquery.js'),
+                      'rb') as original:
+                assert f.read() == original.read()
+
+        html = rst2html('text', asset_dir=asset_dir, jquery=True,
+                        asset_url='https://cdn.example.com/static/')
+        assert '<script src="https://cdn.example.com/static/%s">' % (
+            names[0]) in html
+        assert sorted(os.listdir(asset_dir)) == names
+
+        # processors registered without links_assets still get a boolean
+        calls = []
+        processors = Writer.post_processors[:]
+        Writer.post_processors[:] = [
+            (key, lambda *args, **kwargs: calls.append((args[1], kwargs)))
+            if key == 'mathjax' else (key, processor)
+            for (key, processor) in processors]
+        try:
+            rst2html('text', asset_dir=asset_dir, mathjax=True)
+        finally:
+            Writer.post_processors[:] = processors
+        assert calls == [(True, {})]
+
+
+def test_embed_images():
+    """
+    Images are embedded once per document and cached until they change.
+    """
+    with temp_dir() as path:
+        png = os.path.join(path, 'a.png')
+        svg = os.path.join(path, 'b.svg')
+        # larger than a chunk to check that the chunks are joined right
+        content = os.urandom(postprocessors.ENCODE_CHUNK_SIZE * 2 + 1)
+        write_file(png, content)
+        write_file(svg, '<svg xmlns="http://www.w3.org/2000/svg"/>')
+
+        rst = '\n\n'.join('.. image:: %s' % image
+                           for image in (png, svg, png, 'c.bmp'))
+        html = rst2html(rst, embed_images=True)
+        uri = 'data:image/png;base64,' + base64.b64encode(content).decode()
+        assert html.count('src="%s"' % uri) == 2
+        assert 'data="data:image/svg+xml;base64,' in html
+        assert 'src="c.bmp"' in html
+        assert png in postprocessors.DATA_URIS
+
+        write_file(png, b'changed')
+        os.utime(png, (1, 1))
+        html = rst2html(rst, embed_images=True,
+                        embed_images_opts='threads=1')
+        assert html.count('data:image/png;base64,%s"' % (
+            base64.b64encode(b'changed').decode())) == 2
+
+    # images of unused substitutions don't reach the tree
+    rst = 'text\n\n.. |logo| image:: /nonexistent/unused.png\n'
+    assert rst2html(rst, embed_images=True) == rst2html(rst)
+
+
+def test_image_size():
+    """
+    Image sizes are read from the headers and used to scale images.
+    """
+    headers = {
+        'a.png': (b'\x89PNG\r\n\x1a\n\0\0\0\rIHDR' +
+                  struct.pack('>II', 40, 30) + b'\0' * 20),
+        'a.gif': b'GIF89a' + struct.pack('<HH', 40, 30) + b'\0' * 20,
+        # APP0 segment before the start of frame
+        'a.jpg': (b'\xff\xd8\xff\xe0\0\x04\0\0\xff\xc0\0\x11\x08' +
+                  struct.pack('>HH', 30, 40) + b'\0' * 20),
+        'a.webp': (b'RIFF\0\0\0\0WEBPVP8X\0\0\0\0\0\0\0\0' +
+                   struct.pack('<I', 39)[:3] + struct.pack('<I', 29)[:3] +
+                   b'\0' * 10),
+        'a.svg': b'<svg xmlns="http://www.w3.org/2000/svg" width="40px"\n'
+                 b'     height="30"><rect/></svg>',
+        'b.svg': b'<?xml version="1.0"?>\n<svg viewBox="0 0 40 30"/>',
+        'c.svg': b'<svg width="100%" height="30"/>',
+        'a.bmp': b'BM' + b'\0' * 40,
+    }
+
+    with temp_dir() as path:
+        for name, content in headers.items():
+            write_file(os.path.join(path, name), content)
+            size = imagesize.get_size(os.path.join(path, name))
+            if name in ('c.svg', 'a.bmp'):
+                assert size is None
+            else:
+                assert size == (40, 30), name
+
+        assert imagesize.get_size(os.path.join(path, 'missing.png')) is None
+
+        cache = imagesize.SizeCache(max_size=2)
+        for name in ('a.png', 'a.gif', 'a.jpg'):
+            assert cache.get(os.path.join(path, name), imagesize._read_size)
+        assert len(cache) == 2 and os.path.join(path, 'a.png') not in cache
+
+        RST("""
+            .. image:: %s
+               :scale: 50
+        """ % os.path.join(path, 'a.png')).assert_contains(
+            'style="width: 20.0px; height: 15.0px;"', 1)
+
+
+def test_tag_index():
+    """
+    Indexed postprocessors get the tags created by the translator.
+    """
+    index = html.TagIndex()
+    section = html.Section(html.Pre('x', class_='code lang-c'),
+                           html.Pre('y'), class_='a b')
+    index.add(section)
+    assert index.findall('pre') == [section[0], section[1]]
+    assert index.findall('pre', 'code') == [section[0]]
+    assert index.findall(cls='b') == [section]
+
+    # tags that lost the name or class they were indexed with are skipped
+    section[0].tag = 'div'
+    section.set('class', 'a')
+    assert index.findall('pre') == [section[1]]
+    assert index.findall(cls='b') == []
+
+    received = []
+
+    def processor(tree, embed, params, index=None):
+        received.append(index)
+        for section in index.findall('section'):
+            section.set('data-seen', 'yes')
+
+    Writer.add_postprocessor('test index', 'test_index', processor, True)
+    try:
+        html_output = rst2html(STREAM_RST, test_index=True)
+    finally:
+        Writer.post_processors.pop()
+        Writer.indexed_postprocessors.discard('test_index')
+        del Writer.settings_spec[2][-2:]
+
+    assert html_output.count('data-seen="yes"') == 1
+    assert [tag.get('class') for tag in received[0].findall('li')] == [
+        None, None]
+
+
+def test_fragment():
+    """
+    Raw html is written verbatim and only parsed when inspected.
+    """
+    source = 'text <input disabled><br> &nbsp;'
+    output = rst2html('.. raw:: html\n\n    %s\n' % source)
+    assert source in output
+
+    # also when postprocessors query the index
+    source = '<div  class="a" >  <b>raw</b>&#32;</div>'
+    rst = '.. raw:: html\n\n    %s\n\n::\n\n    code\n' % source
+    for settings in ({'embed_images': True}, {'pygments': True}):
+        assert source in rst2html(rst, **settings)
+
+    fragment = html.Fragment('a <b class="x">bold</b> c')
+    index = html.TagIndex()
+    index.add(html.Div(fragment))
+    assert index.findall('img') == []
+    assert fragment._parsed is None
+    assert str(pickle.loads(pickle.dumps(copy.deepcopy(fragment)))) == (
+        'a <b class="x">bold</b> c')
+    assert fragment._parsed is None
+
+    assert index.findall(cls='x') == [fragment[0]]
+    fragment[0].text = 'changed'
+    assert str(fragment) == 'a <b class="x">changed</b> c'
+
+    # html that isn't well formed stays verbatim
+    fragment = html.Fragment('<input disabled>')
+    assert len(fragment) == 0
+    assert str(fragment) == '<input disabled>'
+
+
+def test_dispatch():
+    """
+    The cached dispatch renders like the docutils one used when debugging.
+    """
+    source = STREAM_RST + '\n.. note:: a note\n\n.. raw:: html\n\n    <hr>\n'
+    output = rst2html(source)
+    assert output == rst2html(source, debug=True,
+                              warning_stream=io.StringIO())
+
+    visited = []
+
+    class Translator(HTMLTranslator):
+        def unknown_visit(self, node):
+            visited.append(node.__class__.__name__)
+            HTMLTranslator.unknown_visit(self, node)
+
+    writer = Writer()
+    writer.translator_class = Translator
+    publish_string(source, writer=writer)
+    assert 'note' in visited and 'raw' in visited
+
+
+def test_translate_jobs():
+    """
+    Top level sections translated in parallel give the serial output.
+    """
+    source = textwrap.dedent("""\
+        Document
+        ========
+
+        Intro with :math:`x^2`.
+
+        .. _other-name:
+
+        First
+        -----
+
+        Text and a `link <First_>`_.
+
+        Nested
+        ~~~~~~
+
+        .. math:: \\frac{a}{b}
+
+        Second
+        ------
+
+        .. raw:: html
+
+            <hr>
+
+        .. note:: a note
+        """)
+
+    for math_output in ('html', 'mathjax'):
+        expected = rst2html(source, math_output=math_output)
+        assert rst2html(source, math_output=math_output,
+                        translate_jobs=2) == expected
+    assert '<h3>Nested</h3>' in expected
+
+    # other threads translate in order instead of forking
+    results = []
+
+    def translate():
+        results.append(parallel._fork_context())
+        results.append(rst2html(source, math_output='mathjax',
+                                translate_jobs=2))
+
+    thread = threading.Thread(target=translate)
+    thread.start()
+    thread.join()
+    assert results == [None, expected]
+
+
+def test_renderer():
+    """
+    A renderer gives the publish_string output for each document.
+    """
+    renderer = Renderer(input_encoding='utf8', math_output='html')
+    sources = [STREAM_RST, SECTIONS_RST.encode('utf8')]
+
+    for source, output in zip(sources, renderer.render_many(sources)):
+        assert output == rst2html(source, math_output='html')
+
+    assert renderer.render('*x*', emit_body=True) == '<p><em>x</em></p>'
+    assert renderer.render('*x*').startswith('<!DOCTYPE html>')
+
+
+def test_batch_render_tree():
+    """
+    Batch rendering of a directory tree.
+    """
+    with temp_dir() as src:
+        with temp_dir() as dst:
+            write_file(os.path.join(src, 'a.rst'), 'first')
+            write_file(os.path.join(src, 'sub', 'b.rst'), 'second')
+            write_file(os.path.join(src, 'bad.rst'), b'\xff\xfe')
+            write_file(os.path.join(src, 'notes.txt'), 'ignored')
+
+            settings = batch.get_settings(input_encoding='utf8')
+            rendered, skipped, failures = batch.render_tree(src, dst,
+                                                            settings, 2)
+
+            assert (rendered, skipped) == (2, 0)
+            assert [path for (path, _) in failures] == [
+                os.path.join(src, 'bad.rst')]
+            assert sorted(os.listdir(dst)) == ['a.html', 'sub']
+            with open(os.path.join(dst, 'sub', 'b.html'), 'rb') as f:
+                assert '<p>second</p>' in f.read().decode('utf8')
+
+            # the batch workers can't start highlighting processes
+            write_file(os.path.join(src, 'a.rst'),
+                       '.. code-block:: python\n\n    a = 1\n\n'
+                       '.. code-block:: python\n\n    b = 2\n')
+            settings = batch.get_settings(input_encoding='utf8',
+                                          pygments=True,
+                                          pygments_opts='jobs=2')
+            rendered, skipped, failures = batch.render_tree(src, dst,
+                                                            settings, 2)
+            assert rendered == 2 and len(failures) == 1
+            with open(os.path.join(dst, 'a.html'), 'rb') as f:
+                assert f.read().decode('utf8').count(
+                    '<div class="code lang-python">') == 2
+
+
+def test_asset_cache():
+    """
+    Assets are cached until they change and evicted when over the limit.
+    """
+    cache = assets.AssetCache(max_size=9)
+    with temp_dir() as path:
+        first = os.path.join(path, 'first.css')
+        second = os.path.join(path, 'second.css')
+        write_file(first, 'a {}')
+        write_file(second, 'b {}')
+
+        assert cache.read(first) == 'a {}'
+        stat = os.stat(first)
+        write_file(first, 'p {}')
+        os.utime(first, (stat.st_atime, stat.st_mtime))
+        assert cache.read(first) == 'a {}'
+
+        os.utime(first, (0, 0))
+        assert cache.read(first) == 'p {}'
+
+        assert cache.read(second) == 'b {}'
+        assert first in cache and cache.size == 8
+
+        write_file(second, 'big {}')
+        os.utime(second, (0, 0))
+        assert cache.read(second) == 'big {}'
+        assert first not in cache and second in cache
+
+
+SECTIONS_RST = """
+
+Second
+======
+
+Math :math:`x^2` and ünïcode.
+
+Third
+=====
+
+.. _other:
+
+Nested
+------
+
+Text.
+"""
+
+STREAM_RST = """
+Title
+=====
+
+Some *text* with a `link <http://example.com/?a=1&b=2>`_.
+
+Section
+-------
+
+* one
+* two
+
+.. raw:: html
+
+    <p class="x">raw &amp; <b>bold</b></p>
+
+.. code-block:: python
+
+    print("<html>")
+"""
+
+
+def test_stream_output():
+    """
+    Streaming the output to a file gives the same output as a string.
+    """
+    spooled = []
+
+    class Translator(HTMLTranslator):
+        def _spool_section(self, node):
+            spooled.append(node['names'])
+            HTMLTranslator._spool_section(self, node)
+
+    source = STREAM_RST + SECTIONS_RST
+
+    for emit_body, jquery in ((False, False), (True, False), (False, True)):
+        settings = {'input_encoding': 'utf8', 'emit_body': emit_body,
+                    'math_output': 'html', 'jquery': jquery}
+        expected = rst2html(source, **settings)
+
+        with temp_dir() as path:
+            src = os.path.join(path, 'in.rst')
+            dst = os.path.join(path, 'out.html')
+            write_file(src, source)
+            settings['stream_output'] = True
+            writer = Writer()
+            writer.translator_class = Translator
+            result = publish_file(source_path=src, destination_path=dst,
+                                  writer=writer,
+                                  settings_overrides=settings)
+
+            assert result is None
+            with open(dst, 'rb') as f:
+                assert f.read().decode('utf8') == expected
+
+    # sections are only spooled when no postprocessor is enabled
+    assert spooled == [['title'], ['second'], ['third']] * 2
+
+
+def test_minify():
+    """
+    Minified output keeps preformatted text and the meaning of the
+    stylesheets and scripts.
+    """
+    source = STREAM_RST + textwrap.dedent("""
+        a paragraph   with
+        several lines
+
+        ::
+
+            keep   these
+              lines
+
+        .. raw:: html
+
+            <div>  raw  </div>
+        """)
+    output = rst2html(source, minify=True)
+
+    assert 'a paragraph with several lines' in output
+    assert '<pre>keep   these\n  lines</pre>' in output
+    assert '<div>  raw  </div>' in output
+    assert '\n' not in output.split('</style>')[-1].split('<pre>')[0]
+    assert len(output) < len(rst2html(source))
+    assert rst2html(source, minify=True, translate_jobs=2) == output
+
+    # the newline ends the LaTeX comment
+    math = '.. math::\n\n   a  % comment\n   + b\n'
+    assert 'a  % comment\n+ b' in rst2html(math, minify=True)
+
+    assert minify.minify_css('a  b , c {\n  color : red ;\n}\n'
+                             '/* x */ p:hover{ margin:0 }') == \
+        'a b,c{color :red}p:hover{margin:0}'
+    assert minify.minify_css('a:after { content: "  ;} " }') == \
+        'a:after{content:"  ;} "}'
+
+    script = textwrap.dedent("""
+        /*! license */
+        var a = 1 // one
+        var b = a + +a, c = "a  // b" /* two */
+        var r = /[ /]+/g.test(c) ? `x ${ { y: `  ` }.y }` : a / 2
+        return
+        """)
+    assert minify.minify_js(script) == (
+        '/*! license */\nvar a=1\nvar b=a+ +a,c="a  // b"\n'
+        'var r=/[ /]+/g.test(c)?`x ${ { y: `  ` }.y }`:a/2\nreturn')
+
+    minify.CACHE.clear()
+    assert minify.minified(script, 'js') is minify.minified(script, 'js')
+    assert len(minify.CACHE) == 1
+
+
+def test_precompress():
+    """
+    Compressed copies of the output are written with it and compressed
+    sources are read.
+    """
+    formats = ['gz']
+    try:
+        import brotli
+        formats.append('br')
+    except ImportError:
+        brotli = None
+
+    with temp_dir() as src:
+        with temp_dir() as dst:
+            write_file(os.path.join(src, 'a.rst'), 'first')
+            with gzip.open(os.path.join(src, 'b.rst.gz'), 'wb') as f:
+                f.write(b'second')
+
+            settings = batch.get_settings(input_encoding='utf8',
+                                          precompress=formats,
+                                          compression_level=1)
+            rendered, _, failures = batch.render_tree(src, dst, settings, 1)
+
+            assert (rendered, failures) == (2, [])
+            assert sorted(os.listdir(dst)) == sorted(
+                ['a.html', 'b.html'] +
+                ['%s.html.%s' % (name, format)
+                 for name in 'ab' for format in formats])
+
+            with open(os.path.join(dst, 'b.html'), 'rb') as f:
+                output = f.read()
+            assert '<p>second</p>' in output.decode('utf8')
+
+            with gzip.open(os.path.join(dst, 'b.html.gz'), 'rb') as f:
+                assert f.read() == output
+
+            if brotli is not None:
+                with open(os.path.join(dst, 'b.html.br'), 'rb') as f:
+                    assert brotli.decompress(f.read()) == output
+
+            # unchanged outputs aren't replaced
+            outputs = [os.path.join(dst, name) for name in os.listdir(dst)]
+            for path in outputs:
+                os.utime(path, (1, 1))
+            batch.render_tree(src, dst, settings, 1)
+            assert [os.path.getmtime(path) for path in outputs] == \
+                [1] * len(outputs)
+            assert not [name for name in os.listdir(dst)
+                        if name.endswith('.tmp')]
+
+            # missing compressed copies are rendered again
+            manifest = os.path.join(dst, 'manifest.json')
+            batch.render_tree(src, dst, settings, 1, manifest)
+            os.remove(os.path.join(dst, 'b.html.gz'))
+            rendered, skipped, _ = batch.render_tree(src, dst, settings, 1,
+                                                     manifest)
+            assert (rendered, skipped) == (1, 1)
+            assert os.path.exists(os.path.join(dst, 'b.html.gz'))
+
+    # a.rst.gz and a.rst are both rendered to a.html
+    with temp_dir() as src:
+        with temp_dir() as dst:
+            write_file(os.path.join(src, 'a.rst'), 'plain')
+            with gzip.open(os.path.join(src, 'a.rst.gz'), 'wb') as f:
+                f.write(b'compressed')
+
+            settings = batch.get_settings(input_encoding='utf8')
+            rendered, _, failures = batch.render_tree(src, dst, settings, 2)
+
+            assert rendered == 1
+            assert [path for (path, _) in failures] == [
+                os.path.join(src, 'a.rst.gz')]
+            with open(os.path.join(dst, 'a.html'), 'rb') as f:
+                assert '<p>plain</p>' in f.read().decode('utf8')
+
+    with temp_dir() as path:
+        try:
+            compress.Output(os.path.join(path, 'out.html'), ['zip'])
+            assert False, 'unknown formats are rejected'
+        except ValueError:
+            assert os.listdir(path) == []
+
+
+def test_append_is_linear():
+    """
+    Appending children and text to a tag takes constant time, the children
+    are never copied or iterated.
+    """
+    iterated = []
+
+    class P(html.P):
+        __slots__ = ()
+
+        def __iter__(self):
+            iterated.append(self)
+            return html.P.__iter__(self)
+
+    tag = P()
+    tag.append('start')
+    tag.append(html.Span())
+    children = tag._children
+
+    for i in range(1000):
+        tag.append(html.Span())
+        tag.append('text')
+
+    assert iterated == []
+    assert tag._children is children and len(children) == 1001
+    assert tag.text == 'start' and children[-1].tail == 'text'
+
+
+def test_attributes_normalized():
+    """
+    Attribute names lose the trailing "_" and values become strings.
+    """
+    cell = html.Td(html.Span('x', class_='inner'), class_='cell', colspan=2)
+    cell.attrib['rowspan'] = 3
+
+    assert cell.attrib == {'class': 'cell', 'colspan': '2', 'rowspan': 3}
+    assert cell[0].attrib == {'class': 'inner'}
+    assert str(cell) == ('<td class="cell" colspan="2" rowspan="3">'
+                         '<span class="inner">x</span></td>')
+
+
+def test_comment():
+    """
+    Comments are kept as html comments.
+    """
+    RST("""
+        .. a comment
+
+        text
+    """).assert_contains('<!--a comment--><p>text</p>', 1)
+    RST("""
+        ..
+
+        text
+    """).assert_contains('<!----><p>text</p>', 1)
+
+
+def test_compact_nodes():
+    """
+    Tags support the ElementTree API used by the postprocessors.
+    """
+    image = html.Img(src='a.png')
+    tag = html.Div(html.P('a', class_='x'), 'b', html.Section(image))
+
+    assert not hasattr(tag, '__dict__')
+    assert html.Div()._attrib is html.Span()._attrib
+    assert html.Div().attrib == {}
+    assert tag[0].tail == 'b'
+    assert tag.findall('.//img') == [image]
+    assert tag.find('./p').get('class') == 'x'
+    assert [el.tag for el in tag.iter()] == ['div', 'p', 'section', 'img']
+
+    copied = copy.deepcopy(tag)
+    copied.find('.//img').set('src', 'b.png')
+    assert str(tag) == ('<div><p class="x">a</p>b<section>'
+                        '<img src="a.png"></section></div>')
+    assert str(copied) == str(tag).replace('a.png', 'b.png')
+    assert str(pickle.loads(pickle.dumps(tag))) == str(tag)
+
+
+def test_batch_incremental():
+    """
+    Incremental builds only render what changed.
+    """
+    with temp_dir() as src:
+        with temp_dir() as dst:
+            manifest = os.path.join(dst, 'manifest.json')
+            write_file(os.path.join(src, 'a.rst'), '.. include:: inc.txt')
+            write_file(os.path.join(src, 'inc.txt'), 'included')
+            write_file(os.path.join(src, 'b.rst'), 'second')
+
+            def build(**kwargs):
+                settings = batch.get_settings(input_encoding='utf8',
+                                              **kwargs)
+                result = batch.render_tree(src, dst, settings, 1, manifest)
+                assert result[2] == []
+                return result[:2]
+
+            assert build() == (2, 0)
+            assert build() == (0, 2)
+
+            write_file(os.path.join(src, 'inc.txt'), 'changed')
+            assert build() == (1, 1)
+            with open(os.path.join(dst, 'a.html'), 'rb') as f:
+                assert '<p>changed</p>' in f.read().decode('utf8')
+
+            # same output, the file is not rewritten
+            output = os.path.join(dst, 'b.html')
+            os.utime(output, (0, 0))
+            write_file(os.path.join(src, 'b.rst'), 'second\n\n')
+            assert build() == (1, 1)
+            assert os.stat(output).st_mtime == 0
+
+            assert build(initial_header_level='2') == (2, 0)
+
+
+def test_watch():
+    """
+    Watch mode renders again the documents whose files changed.
+    """
+    with temp_dir() as path:
+        src = os.path.join(path, 'src')
+        dst = os.path.join(path, 'dst')
+        write_file(os.path.join(src, 'a.rst'), '.. include:: inc.txt\n')
+        write_file(os.path.join(src, 'inc.txt'), 'included\n')
+        write_file(os.path.join(src, 'b.rst'), 'second\n')
+
+        settings = batch.get_settings(_disable_config=True, traceback=True)
+        watcher = watch.Watcher(src, dst, settings, debounce=0,
+                                stream=io.StringIO())
+        assert len(watcher.poll()) == 2
+        assert watcher.poll() == []
+
+        def touch(name, content):
+            write_file(os.path.join(src, name), content)
+            # make sure the change is seen with coarse mtimes
+            os.utime(os.path.join(src, name), (1, 1))
+
+        touch('inc.txt', 'changed\n')
+        assert watcher.poll() == [(os.path.join(src, 'a.rst'),
+                                   os.path.join(dst, 'a.html'))]
+        with open(os.path.join(dst, 'a.html'), 'rb') as f:
+            assert '<p>changed</p>' in f.read().decode('utf8')
+
+        touch('c.rst', 'third\n')
+        assert [paths[0] for paths in watcher.poll()] == [
+            os.path.join(src, 'c.rst')]
+        assert os.path.exists(os.path.join(dst, 'c.html'))
+
+
+def test_server():
+    """
+    The render service renders requests and reports its statistics.
+    """
+    try:
+        from urllib.request import Request, urlopen
+        from urllib.error import HTTPError
+    except ImportError:
+        from urllib2 import HTTPError, Request, urlopen
+
+    settings = batch.get_settings(_disable_config=True)
+    service = server.make_server('0', settings, 2, quiet=True)
+    thread = threading.Thread(target=service.serve_forever)
+    thread.start()
+    assert service.server_address[0] == '127.0.0.1'
+    url = 'http://127.0.0.1:%d' % service.server_address[1]
+
+    def request(path, data=None, content_type='text/plain'):
+        req = Request(url + path, data, {'Content-Type': content_type})
+        response = urlopen(req)
+        try:
+            return response.read().decode('utf8')
+        finally:
+            response.close()
+
+    # the documents can't include files or raw content
+    untrusted = {'raw_enabled': False, 'file_insertion_enabled': False}
+
+    try:
+        assert request('/render', STREAM_RST.encode('utf8')) == \
+            rst2html(STREAM_RST, **untrusted)
+        assert request('/render?part=body&math_output=html',
+                       STREAM_RST.encode('utf8')) == \
+            rst2html(STREAM_RST, emit_body=True, math_output='html',
+                     **untrusted)
+        data = {'source': STREAM_RST, 'part': 'body'}
+        assert request('/render', json.dumps(data).encode('utf8'),
+                       'application/json') == \
+            rst2html(STREAM_RST, emit_body=True, **untrusted)
+
+        for query in ('no_such_setting=1', 'stylesheet_path=/etc/passwd',
+                      'translate_jobs=2', 'math_output=html%20/etc/passwd'):
+            try:
+                request('/render?' + query, b'text')
+            except HTTPError as error:
+                assert error.code == 400
+            else:
+                assert False, 'settings that use files are rejected'
+
+        for data in ([STREAM_RST], {'source': 1}, {'source': 'text',
+                                                   'settings': ['minify']},
+                     {'source': 'text', 'part': ['body']}):
+            try:
+                request('/render', json.dumps(data).encode('utf8'),
+                        'application/json')
+            except HTTPError as error:
+                assert error.code == 400
+            else:
+                assert False, 'requests with the wrong shape are rejected'
+
+        with temp_dir() as path:
+            included = os.path.join(path, 'secret.txt')
+            write_file(included, 'secret')
+            source = '.. include:: %s\n\n.. raw:: html\n\n   <b>raw</b>\n'
+            output = request('/render?part=body',
+                             (source % included).encode('utf8'))
+            assert 'secret' not in output.replace(included, '')
+            assert '<b>raw</b>' not in output
+
+        assert json.loads(request('/health'))['status'] == 'ok'
+        stats = json.loads(request('/stats'))
+        assert stats['requests'] == 12
+        assert stats['errors'] == 8
+        assert stats['workers'] == 2
+        assert stats['latency']['max'] >= stats['latency']['p50'] > 0
+    finally:
+        service.shutdown()
+        service.server_close()
+        thread.join()
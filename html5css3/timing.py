@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""
+Timing of the phases of a ``html5css3`` translation.
+
+A ``Timings`` object records the wall and CPU time of the translator walk,
+each postprocessor, the default stylesheets and the serialization, and the
+number of visits and time spent in the translator for each docutils node
+type.
+"""
+
+from __future__ import absolute_import
+
+import contextlib
+import json
+import time
+import timeit
+from collections import OrderedDict
+
+
+try:
+    process_time = time.process_time
+except AttributeError:
+    process_time = time.clock
+
+
+class Timings(object):
+    """
+    Wall and CPU time of the phases of the translation of one document.
+    """
+
+    def __init__(self, source=None):
+        self.source = source
+        self.phases = OrderedDict()
+        self.postprocessors = OrderedDict()
+        self.nodes = {}
+
+    @contextlib.contextmanager
+    def phase(self, name, group=None):
+        """
+        Add the time spent in the block to the phase ``name``, ``group`` is
+        the dict where the times are added, ``phases`` by default.
+        """
+        if group is None:
+            group = self.phases
+
+        wall = timeit.default_timer()
+        cpu = process_time()
+        try:
+            yield
+        finally:
+            entry = group.setdefault(name, [0.0, 0.0])
+            entry[0] += timeit.default_timer() - wall
+            entry[1] += process_time() - cpu
+
+    def postprocessor(self, name):
+        "add the time spent in the block to the postprocessor ``name``"
+        return self.phase(name, self.postprocessors)
+
+    def node(self, name, elapsed, visits=0):
+        "add a visit or departure of the node type ``name``"
+        entry = self.nodes.get(name)
+        if entry is None:
+            entry = self.nodes[name] = [0, 0.0]
+        entry[0] += visits
+        entry[1] += elapsed
+
+    def as_dict(self):
+        "return the timings as a dict that can be dumped to JSON"
+        def times(group):
+            return OrderedDict((name, {'wall': wall, 'cpu': cpu})
+                               for (name, (wall, cpu)) in group.items())
+
+        phases = list(self.phases.values()) + list(
+            self.postprocessors.values())
+
+        return OrderedDict([
+            ('source', self.source),
+            ('total', {'wall': sum(wall for (wall, _) in phases),
+                       'cpu': sum(cpu for (_, cpu) in phases)}),
+            ('phases', times(self.phases)),
+            ('postprocessors', times(self.postprocessors)),
+            ('nodes', OrderedDict(
+                (name, {'visits': visits, 'wall': wall})
+                for (name, (visits, wall)) in sorted(
+                    self.nodes.items(), key=lambda item: -item[1][1]))),
+        ])
+
+    def write(self, path):
+        "append the timings as one line of JSON to the file at path"
+        with open(path, 'a') as f:
+            f.write(json.dumps(self.as_dict()) + '\n')
+
+
+class NullTimings(object):
+    """
+    Timings that don't record anything, used when timing is disabled.
+    """
+
+    @contextlib.contextmanager
+    def phase(self, name, group=None):
+        yield
+
+    postprocessor = phase
+
+
+NULL_TIMINGS = NullTimings()
+
+
+_timed_classes = {}
+
+
+def timed_translator(translator_class):
+    """
+    Return a subclass of translator_class that records the visits and the
+    time spent visiting and departing each node type in ``self.timings``.
+    """
+    cls = _timed_classes.get(translator_class)
+
+    if cls is None:
+        # the docutils visitors are old style classes on python 2, no super
+        class TimedTranslator(translator_class):
+            timings = None
+
+            def dispatch_visit(self, node):
+                start = timeit.default_timer()
+                try:
+                    return translator_class.dispatch_visit(self, node)
+                finally:
+                    self.timings.node(node.__class__.__name__,
+                                      timeit.default_timer() - start, 1)
+
+            def dispatch_departure(self, node):
+                start = timeit.default_timer()
+                try:
+                    return translator_class.dispatch_departure(self, node)
+                finally:
+                    self.timings.node(node.__class__.__name__,
+                                      timeit.default_timer() - start)
+
+        TimedTranslator.__name__ = 'Timed' + translator_class.__name__
+        cls = _timed_classes[translator_class] = TimedTranslator
+
+    return cls
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""
+Watch mode for ``html5css3``.
+
+Renders a document, or every source below a directory, and keeps running,
+rendering a document again when its source, the files it includes or the
+assets it embeds change. Everything stays loaded between renders, docutils,
+the writer and the asset, math and highlight caches, so a change is
+rendered in a few milliseconds.
+"""
+
+from __future__ import absolute_import
+
+import copy
+import os
+import sys
+import time
+import timeit
+
+from . import Writer, batch
+
+
+# seconds between checks for changed files
+POLL_INTERVAL = 0.1
+# seconds without changes to wait before rendering, for editors that save
+# in several steps and for several files saved at once
+DEBOUNCE = 0.05
+
+
+def _stamp(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime, stat.st_size
+
+
+class Watcher(object):
+    """
+    Keep a set of documents rendered.
+
+    ``source`` and ``destination`` are a source file and its output file
+    or a source and a destination directory.
+    """
+
+    def __init__(self, source, destination, settings,
+                 debounce=DEBOUNCE, stream=None):
+        self.source = source
+        self.destination = destination
+        self.settings = settings
+        self.debounce = debounce
+        self.stream = stream or sys.stderr
+        self.writer = Writer()
+        # (source, destination) -> {path: stamp} of the files it depends on
+        self.documents = {}
+
+    def sources(self):
+        "return the (source path, destination path) to keep rendered"
+        if os.path.isdir(self.source):
+            return list(batch.find_sources(self.source, self.destination))
+        else:
+            return [(self.source, self.destination)]
+
+    def check(self):
+        "return the documents that changed since the last check"
+        stamps = {}
+
+        def stamp(path):
+            if path not in stamps:
+                stamps[path] = _stamp(path)
+            return stamps[path]
+
+        changed = set()
+        sources = self.sources()
+
+        for paths in set(self.documents) - set(sources):
+            del self.documents[paths]
+
+        for paths in sources:
+            files = self.documents.get(paths)
+
+            if files is None:
+                # new document, its other files are known once rendered
+                self.documents[paths] = {paths[0]: stamp(paths[0])}
+                changed.add(paths)
+                continue
+
+            for path, old_stamp in files.items():
+                new_stamp = stamp(path)
+                if new_stamp != old_stamp:
+                    files[path] = new_stamp
+                    changed.add(paths)
+
+        return changed
+
+    def render(self, source_path, destination_path):
+        "render a document, return the error message or None"
+        dirname = os.path.dirname(destination_path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+        # stamp before rendering, a change while rendering renders again
+        stamp = _stamp(source_path)
+        start = timeit.default_timer()
+        error, dependencies = batch.render_document(
+            source_path, destination_path, self.settings, self.writer)
+        elapsed = timeit.default_timer() - start
+
+        paths = (source_path, destination_path)
+        files = self.documents.get(paths, {}) if error else {}
+        files[source_path] = stamp
+
+        for path in dependencies:
+            if path not in files:
+                files[path] = _stamp(path)
+
+        self.documents[paths] = files
+
+        if error is None:
+            self.stream.write('%s rendered in %.0fms\n' % (
+                destination_path, elapsed * 1000))
+        else:
+            self.stream.write('%s: %s\n' % (source_path, error))
+
+        return error
+
+    def poll(self):
+        """
+        Render the documents that changed once the changes settle, return
+        the list of rendered documents.
+        """
+        changed = self.check()
+        if not changed:
+            return []
+
+        while True:
+            time.sleep(self.debounce)
+            more = self.check()
+            if not more:
+                break
+            changed.update(more)
+
+        changed = sorted(changed)
+        for source_path, destination_path in changed:
+            self.render(source_path, destination_path)
+
+        return changed
+
+    def run(self, interval=POLL_INTERVAL):
+        "render and check for changes every ``interval`` seconds, forever"
+        while True:
+            self.poll()
+            time.sleep(interval)
+
+
+def run(settings, stream=None):
+    """
+    Watch from parsed command line settings, return the exit status.
+    """
+    stream = stream or sys.stderr
+    source = settings._source
+    destination = settings._destination
+
+    if not (source and destination and os.path.exists(source)):
+        stream.write('--watch needs a source and a destination\n')
+        return 2
+
+    settings = copy.copy(settings)
+    # keep running when a document fails
+    settings.traceback = True
+
+    watcher = Watcher(source, destination, settings, stream=stream)
+    stream.write('watching %s, press Ctrl+C to stop\n' % source)
+
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        pass
+
+    return 0